@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic C header files of arbitrary size for benchmarking.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import argparse
+import sys
+
+
+# The kinds of declarations the generated headers cycle through.
+DECLARATION_KINDS = ['struct', 'typedef_chain', 'function_prototype',
+                     'nested_anonymous_records', 'function_pointer',
+                     'define_constant']
+
+# Types defined in system headers to exercise the external type handling.
+EXTERNAL_TYPES = ['uint8_t', 'int32_t', 'uint64_t', 'size_t', 'FILE']
+
+
+def _get_struct(number):
+    """
+    A struct referring to the struct generated before it.
+    """
+    lines = ['struct struct_%i {' % number,
+             '    int field_a;',
+             '    %s field_b;' % EXTERNAL_TYPES[number % len(EXTERNAL_TYPES)],
+             '    double field_c[4];']
+    if number:
+        lines.append('    struct struct_%i *previous;' % (number - 1))
+    lines.append('};')
+    return lines
+
+
+def _get_typedef_chain(number):
+    """
+    A chain of three typedefs on top of an external type.
+    """
+    base = EXTERNAL_TYPES[number % (len(EXTERNAL_TYPES) - 1)]
+    return ['typedef %s typedef_%i_a;' % (base, number),
+            'typedef typedef_%i_a typedef_%i_b;' % (number, number),
+            'typedef typedef_%i_b typedef_%i_c;' % (number, number)]
+
+
+def _get_function_prototype(number):
+    """
+    A function prototype using a record and an external type.
+    """
+    # The struct has to be declared before the prototype, otherwise it would
+    # only be declared in the prototype's scope.
+    return ['struct record_%i {' % number,
+            '    int value;',
+            '};',
+            'int function_%i(const char *name, %s value, '
+            'struct record_%i *record);' % (number,
+            EXTERNAL_TYPES[number % len(EXTERNAL_TYPES)], number)]
+
+
+def _get_nested_anonymous_records(number):
+    """
+    A typedefed anonymous struct containing anonymous structs and unions.
+    """
+    return ['typedef struct {',
+            '    int kind;',
+            '    union {',
+            '        struct {',
+            '            float x;',
+            '            float y;',
+            '        } point;',
+            '        %s raw;' % EXTERNAL_TYPES[number % len(EXTERNAL_TYPES)],
+            '    } data;',
+            '    struct {',
+            '        unsigned int flags;',
+            '    } meta;',
+            '} nested_%i;' % number]
+
+
+def _get_function_pointer(number):
+    """
+    A function pointer typedef and a struct with a function pointer member.
+    """
+    return ['typedef void (*callback_%i)(void *data, int length);' % number,
+            'struct callbacks_%i {' % number,
+            '    int (*compare)(const void *a, const void *b);',
+            '    callback_%i on_data;' % number,
+            '};']
+
+
+def _get_define_constant(number):
+    return ['#define CONSTANT_%i %i' % (number, number)]
+
+
+_GENERATORS = {
+    'struct': _get_struct,
+    'typedef_chain': _get_typedef_chain,
+    'function_prototype': _get_function_prototype,
+    'nested_anonymous_records': _get_nested_anonymous_records,
+    'function_pointer': _get_function_pointer,
+    'define_constant': _get_define_constant}
+
+
+def iter_header_lines(declarations, kinds=None):
+    """
+    Yields the lines of a header with the given number of declarations. The
+    declarations cycle through the given kinds, by default all of
+    DECLARATION_KINDS.
+
+    >>> for line in iter_header_lines(2, kinds=['define_constant']):
+    ...     print line
+    #include <stdint.h>
+    #include <stddef.h>
+    #include <stdio.h>
+    <BLANKLINE>
+    #define CONSTANT_0 0
+    #define CONSTANT_1 1
+    """
+    kinds = kinds or DECLARATION_KINDS
+    for kind in kinds:
+        if kind not in _GENERATORS:
+            msg = 'Unknown declaration kind %s.' % kind
+            raise ValueError(msg)
+    yield '#include <stdint.h>'
+    yield '#include <stddef.h>'
+    yield '#include <stdio.h>'
+    yield ''
+    for number in xrange(declarations):
+        for line in _GENERATORS[kinds[number % len(kinds)]](number):
+            yield line
+
+
+def write_header(filename, declarations, kinds=None):
+    """
+    Writes a header with the given number of declarations to filename.
+    """
+    with open(filename, 'w') as file_object:
+        for line in iter_header_lines(declarations, kinds):
+            file_object.write(line + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic C header file.')
+    parser.add_argument('declarations', type=int,
+        help='The number of declarations.')
+    parser.add_argument('-o', '--output',
+        help='Output filename. Defaults to stdout.')
+    parser.add_argument('-k', '--kind', action='append', dest='kinds',
+        choices=DECLARATION_KINDS,
+        help='Only generate declarations of this kind. Can be given '
+             'multiple times.')
+    args = parser.parse_args(argv)
+    if args.output:
+        write_header(args.output, args.declarations, args.kinds)
+        return
+    for line in iter_header_lines(args.declarations, args.kinds):
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
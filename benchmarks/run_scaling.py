@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures how the time spent in each phase of a conversion scales with the
+number of declarations in a header.
+
+Run it with
+
+    python -m benchmarks.run_scaling --sizes 10 100 1000 10000
+
+For every phase, the scaling exponent between two consecutive sizes is
+printed as well. It is about 1 for phases that scale linearly and clearly
+larger for superlinear ones.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+from head2cydef import CFileParser
+from head2cydef.head2cydef import PARSE_PROFILES
+from head2cydef.stats import ParserStats
+
+from generate_header import DECLARATION_KINDS, write_header
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+
+def run_benchmark(declarations, repeat=3, kinds=None, **kwargs):
+    """
+    Converts a synthetic header with the given number of declarations repeat
+    times. Returns the statistics of the fastest run as returned by
+    ParserStats.to_dict().
+
+    All further keyword arguments are passed to CFileParser.
+    """
+    # Each header needs its own directory as all files in the directory of a
+    # header are considered to be part of it.
+    directory = tempfile.mkdtemp(prefix='head2cydef_benchmark_')
+    try:
+        filename = os.path.join(directory, 'synthetic.h')
+        write_header(filename, declarations, kinds)
+        best = None
+        for _ in xrange(repeat):
+            parser = CFileParser(filename, **kwargs)
+            with open(os.devnull, 'w') as file_object:
+                parser.render_cython_header(file_object)
+            stats = parser.stats.to_dict()
+            if best is None or stats['total_time'] < best['total_time']:
+                best = stats
+    finally:
+        shutil.rmtree(directory)
+    return best
+
+
+def get_scaling_exponents(sizes, results):
+    """
+    Returns, for every phase, the list of scaling exponents between
+    consecutive sizes, e.g. the slope in a log-log plot. None if one of the
+    timings is too small to be meaningful.
+
+    >>> results = [{'timings': {'parse': 0.1}, 'total_time': 0.1},
+    ...            {'timings': {'parse': 1.0}, 'total_time': 1.0},
+    ...            {'timings': {'parse': 100.0}, 'total_time': 100.0}]
+    >>> get_scaling_exponents([10, 100, 1000], results)['parse']
+    [1.0, 2.0]
+    """
+    exponents = {}
+    phases = ParserStats.PHASES + ['total']
+    for phase in phases:
+        exponents[phase] = []
+        for (size_1, result_1), (size_2, result_2) in zip(
+                zip(sizes, results), zip(sizes[1:], results[1:])):
+            if phase == 'total':
+                time_1, time_2 = result_1['total_time'], result_2['total_time']
+            else:
+                time_1 = result_1['timings'].get(phase, 0.0)
+                time_2 = result_2['timings'].get(phase, 0.0)
+            # Timings below a millisecond are mostly noise.
+            if time_1 < 1E-3 or time_2 < 1E-3 or size_1 == size_2:
+                exponents[phase].append(None)
+                continue
+            exponents[phase].append(round(math.log(time_2 / time_1) /
+                                          math.log(float(size_2) / size_1),
+                                          2))
+    return exponents
+
+
+def format_report(sizes, results):
+    """
+    Formats the timings of all sizes and the scaling exponents as a table.
+    """
+    phases = ParserStats.PHASES + ['total']
+    lines = []
+    lines.append('%-10s' % 'size' + ''.join('%16s' % _i for _i in phases) +
+                 '%10s' % 'lines')
+    for size, result in zip(sizes, results):
+        timings = [result['timings'].get(_i, 0.0) for _i in
+                   ParserStats.PHASES] + [result['total_time']]
+        lines.append('%-10i' % size + ''.join('%14.4f s' % _i for _i in
+                                              timings) +
+                     '%10i' % result['output_lines'])
+    if len(sizes) > 1:
+        lines.append('')
+        lines.append('Scaling exponents (1 is linear):')
+        exponents = get_scaling_exponents(sizes, results)
+        for index in xrange(len(sizes) - 1):
+            values = []
+            for phase in phases:
+                value = exponents[phase][index]
+                values.append('%16s' % ('-' if value is None else
+                                        '%.2f' % value))
+            lines.append('%-10s' % ('%i->%i' % (sizes[index],
+                                                sizes[index + 1])) +
+                         ''.join(values))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure how the conversion scales with the size of a '
+                    'header.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+        help='The numbers of declarations to benchmark. Defaults to %s.' %
+             ' '.join(str(_i) for _i in DEFAULT_SIZES))
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='Convert every header this many times and report the fastest '
+             'run.')
+    parser.add_argument('-k', '--kind', action='append', dest='kinds',
+        choices=DECLARATION_KINDS,
+        help='Only generate declarations of this kind. Can be given '
+             'multiple times.')
+    parser.add_argument('--profile', choices=sorted(PARSE_PROFILES),
+        default='default', help='The libclang parse profile.')
+    parser.add_argument('--lazy', action='store_true',
+        help='Use the lazy parsing mode.')
+    parser.add_argument('--json', metavar='FILENAME',
+        help='Also write all results as JSON to this file.')
+    args = parser.parse_args(argv)
+
+    sizes = sorted(args.sizes)
+    results = []
+    for size in sizes:
+        results.append(run_benchmark(size, repeat=args.repeat,
+                                     kinds=args.kinds, profile=args.profile,
+                                     lazy=args.lazy))
+        sys.stderr.write('Finished %i declarations in %.2f s.\n' % (size,
+                         results[-1]['total_time']))
+    print format_report(sizes, results)
+    if args.json:
+        with open(args.json, 'w') as file_object:
+            json.dump({'sizes': sizes, 'results': results,
+                       'exponents': get_scaling_exponents(sizes, results)},
+                      file_object, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
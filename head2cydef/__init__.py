@@ -3,7 +3,14 @@ from __future__ import with_statement
 import inspect
 import os
 
-from head2cydef import CFileParser
+# Rendering snapshots does not need libclang, see snapshot.py. Only a missing
+# libclang is tolerated, all other import errors are real errors.
+try:
+    import clang.cindex
+except ImportError:
+    pass
+else:
+    from head2cydef import CFileParser
 
 local_path = os.path.split(inspect.getfile(inspect.currentframe()))[0]
 
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Convert many C header files at once by distributing the single conversions to
+a pool of worker processes.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from collections import namedtuple, OrderedDict
+import multiprocessing
+import os
+import time
+import traceback
+
+from manifest import Manifest
+from session import ParserSession
+
+
+# The result of a single conversion. It has to be picklable to be able to send
+# it back from the worker processes. dependencies is the include closure of
+# the header, skipped is True if the output was up to date, stats is the
+# dictionary returned by ParserStats.to_dict() or None, changed is True if any
+# output file was written and generated is the list of all output files, e.g.
+# also the further files written with split.
+ConversionResult = namedtuple('ConversionResult', ['header', 'output',
+    'success', 'error', 'duration', 'dependencies', 'skipped', 'stats',
+    'changed', 'generated'])
+
+# Parser arguments that do not influence the generated output and thus are not
+# recorded in the manifest.
+_OUTPUT_NEUTRAL_ARGUMENTS = ['cache_dir']
+
+# The ParserSession of a worker process. Every call of iter_convert_many()
+# starts new workers, so the session never outlives a single call.
+_session = None
+
+
+def _init_worker(parser_kwargs):
+    global _session
+    _session = ParserSession(**parser_kwargs)
+
+
+def _convert_header(task, session=None):
+    """
+    Convert a single header. Runs in a worker process and therefore never
+    raises but reports all errors in the returned ConversionResult.
+
+    Uses the session of the worker process if session is not given.
+    """
+    header, output, render_kwargs = task
+    if session is None:
+        session = _session
+    start = time.time()
+    try:
+        parser = session.parse(header)
+        written = render_output(parser, output, **render_kwargs)
+        # Free libclang's memory right away. The include closure and the
+        # statistics are still available afterwards.
+        parser.detach()
+    except Exception:
+        return ConversionResult(header, output, False, traceback.format_exc(),
+                                time.time() - start, [], False, None, False,
+                                [])
+    return ConversionResult(header, output, True, None, time.time() - start,
+                            parser.get_include_closure(), False,
+                            parser.stats.to_dict(), any(written.itervalues()),
+                            written.keys())
+
+
+def render_output(parser, output, only_if_changed=False, split=False):
+    """
+    Renders a parsed header to output, split into one file per source header
+    if split is True. Returns an OrderedDict mapping all output files to
+    whether or not they were written.
+    """
+    if split:
+        return parser.render_split_cython_headers(output, only_if_changed)
+    return OrderedDict([(output, parser.render_cython_header(output,
+                                                             only_if_changed))])
+
+
+def get_default_output_filename(header):
+    """
+    Default output filename for a header, e.g. the same filename with a .pxd
+    extension.
+
+    >>> print get_default_output_filename('/some/path/header.h')
+    /some/path/header.pxd
+    """
+    return os.path.splitext(header)[0] + '.pxd'
+
+
+def _iter_convert_tasks(tasks, jobs, parser_kwargs):
+    """
+    Run all tasks and yield the results as they are finished. Every process
+    parses its headers with one ParserSession created from parser_kwargs.
+    """
+    if not tasks:
+        return
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = max(1, min(jobs, len(tasks)))
+
+    if jobs == 1:
+        session = ParserSession(**parser_kwargs)
+        for task in tasks:
+            yield _convert_header(task, session)
+        return
+
+    pool = multiprocessing.Pool(processes=jobs, initializer=_init_worker,
+                                initargs=(parser_kwargs,))
+    try:
+        # chunksize=1 so a few big headers do not end up in the same worker.
+        for result in pool.imap_unordered(_convert_header, tasks, chunksize=1):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def iter_convert_many(headers, outputs=None, jobs=None, manifest=None,
+                      only_if_changed=False, split=False, **kwargs):
+    """
+    Convert all headers and yield one ConversionResult for each header as soon
+    as it is finished. The order of the results is thus not necessarily the
+    order of the headers.
+
+    :param headers: List of header filenames.
+    :param outputs: List of output filenames, one for each header. Defaults to
+        the header filenames with a .pxd extension.
+    :param jobs: The number of worker processes. Defaults to the number of
+        CPUs. If it is 1, everything runs in the current process.
+    :param manifest: Filename of a manifest or a Manifest instance. If given,
+        only headers whose output is missing or whose include closure changed
+        since the last run are converted. All others are reported as skipped.
+    :param only_if_changed: If True, output files are only replaced if their
+        content changes, so unchanged files keep their modification time.
+    :param split: If True, write one file per header the declarations are
+        in, see CFileParser.render_split_cython_headers().
+
+    All further keyword arguments are passed to CFileParser.
+    """
+    headers = list(headers)
+    if outputs is None:
+        outputs = [get_default_output_filename(_i) for _i in headers]
+    outputs = list(outputs)
+    if len(headers) != len(outputs):
+        msg = 'Need exactly one output filename for every header.'
+        raise ValueError(msg)
+    # Split files of headers including the same files would only differ if
+    # just some symbols are converted.
+    if split and kwargs.get('symbols') is not None and len(headers) > 1:
+        msg = ('Only one header at a time can be converted with split and '
+               'symbols as they might write different versions of the same '
+               'file.')
+        raise ValueError(msg)
+    render_kwargs = {'only_if_changed': only_if_changed, 'split': split}
+    if manifest is None:
+        tasks = [(header, output, render_kwargs) for header, output
+                 in zip(headers, outputs)]
+        for result in _iter_convert_tasks(tasks, jobs, kwargs):
+            yield result
+        return
+
+    if isinstance(manifest, basestring):
+        manifest = Manifest(manifest)
+    settings = dict((key, value) for key, value in kwargs.iteritems()
+                    if key not in _OUTPUT_NEUTRAL_ARGUMENTS)
+    settings['split'] = split
+    tasks = []
+    for header, output in zip(headers, outputs):
+        if manifest.is_up_to_date(header, output, settings):
+            yield ConversionResult(header, output, True, None, 0.0, [], True,
+                                   None, False, [])
+            continue
+        tasks.append((header, output, render_kwargs))
+    try:
+        for result in _iter_convert_tasks(tasks, jobs, kwargs):
+            if result.success:
+                manifest.update(result.header, result.output,
+                                result.dependencies, settings,
+                                result.generated)
+            else:
+                manifest.remove(result.output)
+            yield result
+    finally:
+        # Always save so the finished conversions are not lost.
+        manifest.save()
+
+
+def convert_many(headers, outputs=None, jobs=None, callback=None, **kwargs):
+    """
+    Convert all headers in parallel and return a list of ConversionResult
+    objects in the order of the headers.
+
+    If given, callback will be called with every ConversionResult as soon as
+    the corresponding conversion is finished.
+    """
+    headers = list(headers)
+    if outputs is None:
+        outputs = [get_default_output_filename(_i) for _i in headers]
+    outputs = list(outputs)
+    results = {}
+    for result in iter_convert_many(headers, outputs, jobs=jobs, **kwargs):
+        if callback is not None:
+            callback(result)
+        results[(result.header, result.output)] = result
+    return [results[_i] for _i in zip(headers, outputs)]
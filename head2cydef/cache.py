@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of parsed libclang translation units.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from clang.cindex import conf, TranslationUnit, TranslationUnitLoadError, \
+    _CXString
+import errno
+from glob import glob
+import json
+import os
+import tempfile
+
+from utils import get_file_hash, get_string_hash
+
+
+def get_libclang_version():
+    """
+    Returns the version string of the loaded libclang library.
+    """
+    # clang_getClangVersion is not registered by the Python bindings, thus
+    # set up the ctypes function by hand.
+    function = conf.lib.clang_getClangVersion
+    function.restype = _CXString
+    function.errcheck = _CXString.from_result
+    return function()
+
+
+class TranslationUnitCache(object):
+    """
+    Stores saved translation units in a directory and loads them again if
+    neither the header, any file it includes, the compiler arguments, the
+    parse options nor the libclang version changed.
+
+    Every header has two files in the cache directory:
+        HEADERKEY.json
+            The include closure of the last parse of the header.
+        HEADERKEY-CONTENTKEY.ast
+            The saved translation unit. CONTENTKEY is a hash of the contents
+            of all files in the include closure.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.libclang_version = get_libclang_version()
+
+    def _get_header_key(self, filename, args, options):
+        # Relative paths in the arguments, e.g. include directories, are
+        # resolved against the working directory.
+        return get_string_hash(os.path.abspath(filename), self.libclang_version,
+                               str(options), os.getcwd(), *(args or []))
+
+    @staticmethod
+    def _get_content_key(header_key, dependencies):
+        """
+        Hashes the contents of all dependencies. Returns None if one of them
+        does not exist anymore.
+        """
+        hashes = [header_key]
+        for filename in sorted(dependencies):
+            if not os.path.exists(filename):
+                return None
+            hashes.append(filename)
+            hashes.append(get_file_hash(filename))
+        return get_string_hash(*hashes)
+
+    def _get_ast_filename(self, header_key, content_key):
+        return os.path.join(self.directory, '%s-%s.ast' % (header_key,
+                                                             content_key))
+
+    def _get_dependency_filename(self, header_key):
+        return os.path.join(self.directory, '%s.json' % header_key)
+
+    def load(self, index, filename, args=None, options=0):
+        """
+        Returns the cached translation unit or None if there is no valid one.
+        """
+        header_key = self._get_header_key(filename, args, options)
+        dependency_file = self._get_dependency_filename(header_key)
+        if not os.path.exists(dependency_file):
+            return None
+        with open(dependency_file, 'r') as file_object:
+            dependencies = json.load(file_object)
+        content_key = self._get_content_key(header_key, dependencies)
+        if content_key is None:
+            return None
+        ast_file = self._get_ast_filename(header_key, content_key)
+        if not os.path.exists(ast_file):
+            return None
+        try:
+            return TranslationUnit.from_ast_file(ast_file, index=index)
+        except TranslationUnitLoadError:
+            # A corrupt or incompatible file. It will be overwritten by the
+            # next call to store().
+            return None
+
+    def store(self, translation_unit, filename, args=None, options=0):
+        """
+        Saves the translation unit of the given header.
+        """
+        header_key = self._get_header_key(filename, args, options)
+        dependencies = set([os.path.abspath(filename)])
+        for include in translation_unit.get_includes():
+            dependencies.add(os.path.abspath(include.include.name))
+        content_key = self._get_content_key(header_key, dependencies)
+        if content_key is None:
+            return
+        # Remove outdated translation units of the same header.
+        for old_file in glob(os.path.join(self.directory,
+                                          '%s-*.ast' % header_key)):
+            try:
+                os.remove(old_file)
+            except OSError as e:
+                # Already removed by a concurrent run.
+                if e.errno != errno.ENOENT:
+                    raise
+        # Write to temporary files first and move them to the final location
+        # so concurrent runs never see half written files.
+        fd, temp_filename = tempfile.mkstemp(dir=self.directory)
+        os.close(fd)
+        translation_unit.save(temp_filename)
+        os.rename(temp_filename, self._get_ast_filename(header_key,
+                                                        content_key))
+        fd, temp_filename = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as file_object:
+            json.dump(sorted(dependencies), file_object)
+        os.rename(temp_filename, self._get_dependency_filename(header_key))
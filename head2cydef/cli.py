@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Command line interface of head2cydef.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+from batch import iter_convert_many, get_default_output_filename
+import daemon
+from head2cydef import PARSE_PROFILES
+from stats import format_stats
+from watch import Watcher
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(prog='head2cydef',
+        description='Convert C header files to Cython definition files.')
+    parser.add_argument('headers', metavar='HEADER', nargs='*',
+        help='C header files to convert.')
+    output_group = parser.add_mutually_exclusive_group()
+    output_group.add_argument('-o', '--output', action='append',
+        dest='outputs', metavar='OUTPUT',
+        help='Output filename. Has to be given once per header. Defaults to '
+             'the header filename with a .pxd extension.')
+    output_group.add_argument('--output-dir', metavar='DIRECTORY',
+        help='Write all output files to this directory.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='Number of parallel worker processes. Defaults to the number '
+             'of CPUs.')
+    parser.add_argument('--cache-dir', metavar='DIRECTORY',
+        help='Cache parsed translation units in this directory and reuse '
+             'them for unchanged headers.')
+    parser.add_argument('--manifest', metavar='FILENAME',
+        help='Record the include closure of every output in this file and '
+             'only regenerate outputs whose closure changed.')
+    parser.add_argument('-s', '--symbol', action='append', dest='symbols',
+        metavar='PATTERN',
+        help='Only convert functions, types and macros matching this name '
+             'or glob pattern plus everything they depend on. Can be given '
+             'multiple times.')
+    parser.add_argument('--split', action='store_true',
+        help='Write one output file per header the declarations are in. The '
+             'files are written next to the output file and cimport the '
+             'types they need from each other.')
+    parser.add_argument('--only-if-changed', action='store_true',
+        help='Only replace output files whose content changes. Unchanged '
+             'files keep their modification time and do not trigger '
+             'rebuilds.')
+    parser.add_argument('--watch', action='store_true',
+        help='Keep running and convert headers again whenever they or a '
+             'file they include change. The headers stay parsed in memory, '
+             'so this is much faster than running head2cydef again.')
+    parser.add_argument('--interval', type=float, default=0.5,
+        metavar='SECONDS',
+        help='How often --watch checks for changes. Defaults to 0.5 s.')
+    parser.add_argument('--stats', action='store_true',
+        help='Print the time spent in each phase and some counters for '
+             'every converted header.')
+    parser.add_argument('--stats-file', metavar='FILENAME',
+        help='Write the statistics of all converted headers as JSON to this '
+             'file.')
+
+    daemon_group = parser.add_argument_group('conversion server')
+    server_group = daemon_group.add_mutually_exclusive_group()
+    server_group.add_argument('--serve', metavar='SOCKET',
+        help='Run a conversion server on this Unix domain socket. It keeps '
+             'the headers parsed in memory and converts them for --connect.')
+    server_group.add_argument('--connect', metavar='SOCKET',
+        help='Let the server on this socket convert the headers. Falls back '
+             'to converting them in this process if no server is running.')
+    server_group.add_argument('--stop-server', metavar='SOCKET',
+        help='Stop the server on this socket.')
+    daemon_group.add_argument('--max-sessions', type=int, default=16,
+        metavar='NUMBER',
+        help='The number of directories and sets of options --serve keeps '
+             'the parsed headers for. Defaults to 16.')
+
+    clang_group = parser.add_argument_group('libclang options')
+    clang_group.add_argument('--profile', choices=sorted(PARSE_PROFILES),
+        help='The libclang parse profile. "fast" skips function bodies, '
+             '"watch" speeds up reparsing. Defaults to "watch" with --watch '
+             'and "default" otherwise.')
+    clang_group.add_argument('--no-macros', action='store_false',
+        dest='macros',
+        help='Do not convert #define constants. Parses faster.')
+    clang_group.add_argument('-I', action='append', dest='include_dirs',
+        default=[], metavar='DIRECTORY',
+        help='Add a directory to the include search path.')
+    clang_group.add_argument('-D', action='append', dest='defines',
+        default=[], metavar='MACRO[=VALUE]',
+        help='Define a macro.')
+    clang_group.add_argument('--std', metavar='STANDARD',
+        help='The language standard, e.g. c99.')
+    clang_group.add_argument('--clang-arg', action='append',
+        dest='clang_args', default=[], metavar='ARG',
+        help='Pass an arbitrary argument to clang.')
+    return parser
+
+
+def get_clang_args(args):
+    """
+    Assemble the compiler arguments passed to clang.
+    """
+    clang_args = ['-I%s' % _i for _i in args.include_dirs]
+    clang_args.extend('-D%s' % _i for _i in args.defines)
+    if args.std:
+        clang_args.append('-std=%s' % args.std)
+    clang_args.extend(args.clang_args)
+    return clang_args
+
+
+def get_output_filenames(args):
+    """
+    Determine the output filename for each header.
+    """
+    if args.outputs:
+        return args.outputs
+    outputs = [get_default_output_filename(_i) for _i in args.headers]
+    if args.output_dir:
+        outputs = [os.path.join(args.output_dir, os.path.basename(_i))
+                   for _i in outputs]
+    return outputs
+
+
+def print_result(result, args):
+    """
+    Print the outcome of a single conversion.
+    """
+    if result.skipped:
+        print 'SKIPPED %s (up to date)' % result.header
+    elif result.success:
+        print 'OK      %s -> %s (%.2f s%s)' % (result.header, result.output,
+            result.duration, '' if result.changed else ', unchanged')
+        if args.stats:
+            for line in format_stats(result.stats).splitlines():
+                print '        %s' % line
+    else:
+        print 'FAILED  %s (%.2f s)' % (result.header, result.duration)
+        sys.stderr.write(result.error)
+    sys.stdout.flush()
+
+
+def watch(args, outputs):
+    """
+    Convert all headers and then again whenever they change until
+    interrupted.
+    """
+    watcher = Watcher(args.headers, outputs,
+                      only_if_changed=args.only_if_changed, split=args.split,
+                      cache_dir=args.cache_dir, symbols=args.symbols,
+                      args=get_clang_args(args),
+                      profile=args.profile or 'watch', macros=args.macros)
+    print 'Watching %i headers. Press Ctrl+C to stop.' % len(outputs)
+    sys.stdout.flush()
+    try:
+        for result in watcher.iter_watch(args.interval):
+            print_result(result, args)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def serve(socket_path, max_sessions):
+    """
+    Run a conversion server until it is stopped or interrupted.
+    """
+    server = daemon.ConversionServer(socket_path, max_sessions)
+    print 'Listening on %s. Press Ctrl+C to stop.' % server.socket_path
+    sys.stdout.flush()
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def stop_server(socket_path):
+    try:
+        daemon.send_request(socket_path, {'command': 'shutdown'})
+    except socket.error:
+        sys.stderr.write('No server is listening on %s.\n' % socket_path)
+        return 1
+    return 0
+
+
+def iter_results(args, outputs):
+    """
+    Convert all headers, with the server given by --connect if one is
+    running, and yield the results. If the server fails, the remaining
+    headers are converted in this process.
+    """
+    parser_kwargs = {'cache_dir': args.cache_dir, 'symbols': args.symbols,
+                     'args': get_clang_args(args), 'macros': args.macros}
+    headers = list(args.headers)
+    outputs = list(outputs)
+    if args.connect:
+        server_kwargs = dict(parser_kwargs)
+        server_kwargs['profile'] = args.profile or 'watch'
+        while headers:
+            try:
+                result = daemon.convert(args.connect, headers[0], outputs[0],
+                                        only_if_changed=args.only_if_changed,
+                                        split=args.split, **server_kwargs)
+            except (socket.error, ValueError, daemon.DaemonError) as e:
+                # Not running, died or sent an invalid reply.
+                message = str(e).strip().splitlines() or \
+                    [e.__class__.__name__]
+                sys.stderr.write('The server on %s failed (%s). Converting '
+                                 'the remaining headers in this process.\n' %
+                                 (args.connect, message[-1]))
+                break
+            del headers[0], outputs[0]
+            yield result
+    parser_kwargs['profile'] = args.profile or 'default'
+    for result in iter_convert_many(headers, outputs, jobs=args.jobs,
+                                    manifest=args.manifest,
+                                    only_if_changed=args.only_if_changed,
+                                    split=args.split, **parser_kwargs):
+        yield result
+
+
+def main(argv=None):
+    parser = get_argument_parser()
+    args = parser.parse_args(argv)
+    if args.serve:
+        return serve(args.serve, args.max_sessions)
+    if args.stop_server:
+        return stop_server(args.stop_server)
+    if not args.headers:
+        parser.error('No headers given.')
+    outputs = get_output_filenames(args)
+    if len(outputs) != len(args.headers):
+        parser.error('Need exactly one --output for every header.')
+    if args.watch and (args.manifest or args.connect):
+        parser.error('--watch cannot be combined with --manifest or '
+                     '--connect.')
+    if args.connect and args.manifest:
+        parser.error('--connect cannot be combined with --manifest.')
+    if args.split and args.symbols and len(args.headers) > 1:
+        parser.error('--split and --symbol can only convert one header at a '
+                     'time.')
+    if args.output_dir and not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    if args.watch:
+        return watch(args, outputs)
+
+    failed = 0
+    all_stats = {}
+    for result in iter_results(args, outputs):
+        print_result(result, args)
+        if not result.success:
+            failed += 1
+        elif not result.skipped:
+            all_stats[result.header] = result.stats
+    print '%i of %i headers converted successfully.' % \
+        (len(outputs) - failed, len(outputs))
+    if args.stats_file:
+        with open(args.stats_file, 'w') as file_object:
+            json.dump(all_stats, file_object, indent=1, sort_keys=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A long running conversion server and its client. The server keeps the parsed
+headers in memory and converts headers for other processes, e.g. a build
+system, over a Unix domain socket. Converting an unchanged header again only
+renders it, a changed one is reparsed.
+
+Requests and replies are JSON objects, one per line. A connection can send
+any number of requests and receives one reply for each.
+
+    {"command": "convert", "header": "a.h", "output": "a.pxd",
+     "directory": "/path", "options": {...},
+     "only_if_changed": false, "split": false}
+        Converts a header. Relative filenames and compiler arguments are
+        relative to directory. The options are passed to CFileParser. The
+        reply contains the fields of a batch.ConversionResult.
+    {"command": "ping"}
+        Replies with {"success": true}.
+    {"command": "clear"}
+        Forgets all parsed headers.
+    {"command": "shutdown"}
+        Stops the server after replying.
+
+Failing requests are answered with {"success": false, "error": "..."}.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from collections import OrderedDict
+import gc
+import json
+import os
+import socket
+import SocketServer
+import traceback
+
+from batch import ConversionResult, get_default_output_filename
+from watch import Watcher
+
+
+class DaemonError(Exception):
+    """
+    Raised by the client if the server cannot handle a request.
+    """
+    pass
+
+
+class ConversionRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Answers every line sent over the connection.
+    """
+    # Requests are handled one after another, so a client that neither sends
+    # nor closes must not block the server forever.
+    timeout = 10.0
+
+    def handle(self):
+        try:
+            for line in iter(self.rfile.readline, ''):
+                if not line.strip():
+                    continue
+                try:
+                    reply = self.server.handle_command(json.loads(line))
+                except Exception:
+                    reply = {'success': False,
+                             'error': traceback.format_exc()}
+                self.wfile.write(json.dumps(reply) + '\n')
+                self.wfile.flush()
+        except socket.timeout:
+            pass
+
+
+class ConversionServer(SocketServer.UnixStreamServer):
+    """
+    Serves conversion requests on a Unix domain socket.
+
+    Requests are handled one after another. libclang is not used from more
+    than one thread and a warm conversion takes only milliseconds. Parsed
+    headers are kept in one watch.Watcher per directory and set of options,
+    at most max_sessions of them.
+    """
+    # Many build jobs might connect at once.
+    request_queue_size = 128
+
+    def __init__(self, socket_path, max_sessions=16):
+        """
+        :param socket_path: The filename of the socket.
+        :param max_sessions: The maximum number of directories and sets of
+            options the parsed headers are kept for. The least recently used
+            ones are dropped first.
+        """
+        self.socket_path = os.path.abspath(socket_path)
+        if os.path.exists(self.socket_path):
+            if is_running(self.socket_path):
+                msg = 'A server is already listening on %s.' % \
+                    self.socket_path
+                raise DaemonError(msg)
+            # Left over from a server that was killed.
+            os.remove(self.socket_path)
+        SocketServer.UnixStreamServer.__init__(self, self.socket_path,
+                                               ConversionRequestHandler)
+        self.max_sessions = max_sessions
+        # Ordered from the least to the most recently used.
+        self.watchers = OrderedDict()
+        self.is_shut_down = False
+
+    def _get_watcher(self, directory, options):
+        key = json.dumps([directory, options], sort_keys=True)
+        watcher = self.watchers.pop(key, None)
+        if watcher is None:
+            watcher = Watcher([], **options)
+            while len(self.watchers) >= self.max_sessions:
+                self.watchers.popitem(last=False)[1].clear()
+                # The parsers and their nodes refer to each other. Collect
+                # them right away to free the translation units.
+                gc.collect()
+        self.watchers[key] = watcher
+        return watcher
+
+    def handle_command(self, request):
+        """
+        Handles a single request and returns the reply.
+        """
+        command = request.get('command')
+        if command == 'ping':
+            return {'success': True}
+        elif command == 'clear':
+            for watcher in self.watchers.itervalues():
+                watcher.clear()
+            self.watchers.clear()
+            gc.collect()
+            return {'success': True}
+        elif command == 'shutdown':
+            self.is_shut_down = True
+            return {'success': True}
+        elif command == 'convert':
+            return self.convert(request)
+        msg = 'Unknown command %s.' % command
+        raise ValueError(msg)
+
+    def convert(self, request):
+        directory = os.path.abspath(request.get('directory') or os.getcwd())
+        header = os.path.join(directory, request['header'])
+        output = request.get('output')
+        if output is None:
+            output = get_default_output_filename(header)
+        output = os.path.join(directory, output)
+        options = dict((str(key), value) for key, value in
+                       (request.get('options') or {}).iteritems())
+        # Relative include directories are resolved by libclang against the
+        # working directory. Requests are handled one after another, so
+        # changing it is safe.
+        current_directory = os.getcwd()
+        os.chdir(directory)
+        try:
+            result = self._get_watcher(directory, options).convert(header,
+                output, only_if_changed=request.get('only_if_changed', False),
+                split=request.get('split', False))
+        finally:
+            os.chdir(current_directory)
+        return result._asdict()
+
+    def serve(self):
+        """
+        Handles requests until a shutdown request arrives.
+        """
+        try:
+            while not self.is_shut_down:
+                self.handle_request()
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def _connect(socket_path, timeout=None):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(socket_path)
+    except:
+        connection.close()
+        raise
+    return connection
+
+
+def is_running(socket_path):
+    """
+    Returns True if a server accepts connections on the socket.
+    """
+    try:
+        _connect(socket_path, timeout=1.0).close()
+    except socket.error:
+        return False
+    return True
+
+
+def send_request(socket_path, request, timeout=None):
+    """
+    Sends a single request to the server and returns its reply. Raises a
+    socket.error if no server is running and a DaemonError if the request
+    failed.
+    """
+    connection = _connect(socket_path, timeout)
+    try:
+        connection.sendall(json.dumps(request) + '\n')
+        reply = connection.makefile('r').readline()
+    finally:
+        connection.close()
+    if not reply:
+        msg = 'The server closed the connection without replying.'
+        raise DaemonError(msg)
+    reply = json.loads(reply)
+    if 'error' in reply and 'header' not in reply:
+        raise DaemonError(reply['error'])
+    return reply
+
+
+def convert(socket_path, header, output=None, only_if_changed=False,
+            split=False, timeout=None, **kwargs):
+    """
+    Converts a header with the server listening on socket_path and returns a
+    batch.ConversionResult. Relative filenames are relative to the current
+    directory. All further keyword arguments are passed to CFileParser and
+    have to be JSON serializable.
+    """
+    request = {'command': 'convert', 'header': header, 'output': output,
+               'directory': os.getcwd(), 'options': kwargs,
+               'only_if_changed': only_if_changed, 'split': split}
+    return ConversionResult(**send_request(socket_path, request, timeout))
@@ -11,90 +11,353 @@ bindings.
     (http://www.gnu.org/copyleft/lesser.html)
 """
 
-from clang.cindex import Index, TypeKind, CursorKind
+from clang.cindex import conf, Index, TypeKind, CursorKind, TranslationUnit, \
+    _CXUnsavedFile
+from collections import OrderedDict
+from ctypes import addressof
+from fnmatch import fnmatchcase
 from glob import glob
 import os
+import re
+import time
 
+from cache import TranslationUnitCache
+from ir import ExternalBlock, Header, Opaque
 from nodes import *
+import snapshot
+from split import get_module_name, split_header
+from stats import ParserStats
+from utils import write_if_changed
+
+
+# Matches include directives and extracts the included filename. Also
+# matches the GNU extension #include_next.
+INCLUDE_PATTERN = re.compile(r'^\s*#\s*include(?:_next)?\s*[<"]([^>"]+)[>"]')
+
+# Named sets of CXTranslationUnit_Flags passed to libclang. The detailed
+# preprocessing record needed for macro definitions is added separately.
+# See:
+#   http://clang.llvm.org/doxygen/group__CINDEX__TRANSLATION__UNIT.html
+PARSE_PROFILES = {
+    'default': TranslationUnit.PARSE_NONE,
+    # Do not parse the bodies of e.g. static inline functions and do not
+    # complain about incomplete declarations at the end of the header.
+    'fast': TranslationUnit.PARSE_SKIP_FUNCTION_BODIES |
+        TranslationUnit.PARSE_INCOMPLETE,
+    # Precompile the leading includes of the header so reparsing it after a
+    # change, e.g. in watch mode, does not parse them again.
+    'watch': TranslationUnit.PARSE_PRECOMPILED_PREAMBLE,
+}
+
+# The node classes for all top level cursor kinds except macro definitions.
+TOPLEVEL_NODE_CLASSES = {
+    CursorKind.TYPEDEF_DECL: TypedefNode,
+    CursorKind.FUNCTION_DECL: FunctionProtoNode,
+    CursorKind.STRUCT_DECL: StructNode,
+    CursorKind.UNION_DECL: UnionNode,
+    CursorKind.ENUM_DECL: EnumNode,
+}
+
+
+def reparse_translation_unit(translation_unit, unsaved_files=None):
+    """
+    Like clang.cindex.TranslationUnit.reparse() but returns False instead of
+    ignoring it if libclang fails. The translation unit must not be used
+    anymore in this case.
+    """
+    unsaved_files = unsaved_files or []
+    unsaved_files_array = 0
+    if unsaved_files:
+        unsaved_files_array = (_CXUnsavedFile * len(unsaved_files))()
+        for i, (name, contents) in enumerate(unsaved_files):
+            unsaved_files_array[i].name = name
+            unsaved_files_array[i].contents = contents
+            unsaved_files_array[i].length = len(contents)
+    # There are no reparse options besides CXReparse_None yet.
+    return conf.lib.clang_reparseTranslationUnit(translation_unit,
+        len(unsaved_files), unsaved_files_array, 0) == 0
 
 
 class CFileParser(object):
     """
     """
-    def __init__(self, filename):
+    def __init__(self, filename, args=None, cache_dir=None, lazy=False,
+                 symbols=None, profile='default', macros=True, index=None,
+                 unsaved_files=None, local_files=None, session=None):
         """
+        :param filename: The header file to parse.
+        :param args: Additional command line arguments passed to clang.
+        :param cache_dir: If given, parsed translation units will be stored in
+            this directory and reused as long as the header, the files it
+            includes and the arguments do not change. Can also be a
+            TranslationUnitCache instance.
+        :param lazy: If True, the top level nodes are only sorted during
+            initialization. Each of them is parsed the first time it is
+            rendered or queried.
+        :param symbols: A list of names or glob patterns of functions, types
+            and macros. If given, only these and all declarations they need,
+            e.g. parameter and return types, typedef targets and struct
+            fields, are parsed and rendered. Implies lazy.
+        :param profile: The name of the libclang parse profile, one of the
+            keys of PARSE_PROFILES.
+        :param macros: Whether or not #define constants are converted. If
+            False, libclang does not need to record the preprocessor
+            directives which speeds up parsing.
+        :param index: A clang.cindex.Index to parse the header with. Sharing
+            one Index between many parsers avoids creating a new one every
+            time. Defaults to a new one.
+        :param unsaved_files: A list of (filename, contents) tuples of files
+            that are not read from disk, see clang.cindex.Index.parse(). The
+            header itself can be one of them. Their names are considered to
+            be part of the library. The cache is not used if given.
+        :param local_files: The files considered to be part of the library in
+            addition to the unsaved files. Only declarations in these are
+            converted, everything else is an external type. Defaults to all
+            files in the directory of the header.
+        :param session: The ParserSession this parser belongs to. The include
+            directives of files that are not part of the library, e.g. system
+            headers, are then only read once per session.
         """
         self.filename = filename
+        self.session = session
+        self.stats = ParserStats()
+        self.symbols = symbols
+        self.lazy = lazy or symbols is not None
+        self.args = args or []
+        self.unsaved_files = list(unsaved_files or [])
+        self._unsaved_sources = dict((os.path.abspath(name), contents) for
+                                     name, contents in self.unsaved_files)
         self.file_directory = os.path.dirname(os.path.abspath(self.filename))
-        # Only parse files in the directory of the initial header file.
-        self.files_to_parse = glob(os.path.join(self.file_directory, '*'))
-
-        self.index = Index.create()
-        # options set the CXTranslationUnit_Flags enum to 1 so it also parses
-        # everything related to the preprocessor.
-        # See:
-        #   http://clang.llvm.org/doxygen/group__CINDEX__TRANSLATION__UNIT.html
-        self.translation_unit = self.index.parse(self.filename, options=1)
+        # By default, only parse files in the directory of the initial header
+        # file.
+        if local_files is None:
+            local_files = glob(os.path.join(self.file_directory, '*'))
+        self.files_to_parse = set(os.path.abspath(_i) for _i in local_files)
+        self.files_to_parse.update(self._unsaved_sources)
+        # Cache whether or not a file is in files_to_parse. One keyed by the
+        # filename and one by the address of libclang's file object.
+        self._is_local_filename = {}
+        self._is_local_file_object = {}
+
+        self.index = index if index is not None else Index.create()
+        if profile not in PARSE_PROFILES:
+            msg = 'Unknown parse profile %s. Available: %s' % (profile,
+                ', '.join(sorted(PARSE_PROFILES)))
+            raise ValueError(msg)
+        self.parse_options = PARSE_PROFILES[profile]
+        # Also parse everything related to the preprocessor to get the macro
+        # definitions.
+        if macros:
+            self.parse_options |= \
+                TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+        self.translation_unit = None
+        self.cache = None
+        if cache_dir is not None and not self.unsaved_files:
+            # The cache can only verify files on disk.
+            if isinstance(cache_dir, TranslationUnitCache):
+                self.cache = cache_dir
+            else:
+                self.cache = TranslationUnitCache(cache_dir)
+        with self.stats.timer('parse'):
+            self._parse_translation_unit()
+        self._process_translation_unit()
+
+    def _parse_translation_unit(self):
+        """
+        Parses the header or loads it from the cache.
+        """
+        self.translation_unit = None
+        # Translation units loaded from the cache cannot be reparsed.
+        self.is_loaded_from_cache = False
+        if self.cache is not None:
+            self.translation_unit = self.cache.load(self.index,
+                self.filename, self.args, self.parse_options)
+            self.is_loaded_from_cache = self.translation_unit is not None
+        if self.translation_unit is None:
+            self.translation_unit = self.index.parse(self.filename,
+                args=self.args, unsaved_files=self.unsaved_files or None,
+                options=self.parse_options)
+            if self.cache is not None:
+                self.cache.store(self.translation_unit, self.filename,
+                                 self.args, self.parse_options)
+
+    def _process_translation_unit(self):
+        """
+        Sets up everything derived from the translation unit and sorts, and
+        unless lazy, parses the nodes.
+        """
         self.cursor = self.translation_unit.cursor
 
         # Get all includes.
-        self.includes = []
-        for _i in self.translation_unit.get_includes():
-            # if os.path.abspath(_i.location.file.name) in self.files_to_parse \
-            #    and os.path.abspath(_i.include.name) not in self.files_to_parse:
-            self.includes.append(_i)
-        # Get the exact include statement.
-        # XXX: I could not find a way to do this within clang. Is there one?
+        self.includes = list(self.translation_unit.get_includes())
+        self.stats.includes = len(self.includes)
+        # Map filenames to the string they are included with. Only filled on
+        # demand by get_include_spelling().
         self.include_map = {}
-        for inc in self.includes:
-            # Open the file to read the correct line.
-            with open(inc.location.file.name, 'r') as open_file:
-                line_of_interest = inc.location.line
-                for _i, line in enumerate(open_file):
-                    if _i + 1 < line_of_interest:
-                        continue
-                    elif _i + 1 == line_of_interest:
-                        include_line = line
-                        break
-                    else:
-                        break
-            # XXX: Replace with regex!
-            include_line = include_line.replace('#', '')
-            include_line = include_line.replace('include', '')
-            include_line = include_line.replace('<', '')
-            include_line = include_line.replace('>', '')
-            include_line = include_line.replace('"', '')
-            # XXX: What is this include_next thing??
-            #      Maybe something llvm exclusive?
-            include_line = include_line.replace('_next', '')
-            include_line = include_line.replace('"', '').strip()
-
-            include_filename = os.path.abspath(inc.include.name)
-            if include_filename in self.include_map:
-                if self.include_map[include_filename] != include_line:
-                    msg = 'Includes referencing same file included with ' + \
-                          'different statements.'
-                    raise Exeption(msg)
-            else:
-                self.include_map[include_filename] = include_line
-            # if 'next' in self.include_map[include_filename]:
-            #     from IPython.core.debugger import Tracer; Tracer()()
+        self._includes_by_filename = None
+        self._include_lines = {}
+        self._include_closure = None
+        # libclang's file objects change with every parse.
+        self._is_local_file_object = {}
 
         self._setup_data_structure()
-        self._sort_toplevel_nodes()
-        self.parse_external_types()
+        with self.stats.timer('sort'):
+            self._sort_toplevel_nodes()
+        self.is_resolved = False
+        self.is_va_list_used = False
+        # The intermediate representation. Built by get_ir().
+        self.ir = None
+        if not self.lazy:
+            self.resolve_nodes()
+
+    def reparse(self, unsaved_files=None):
+        """
+        Parses the header again, e.g. after it or one of the files it includes
+        changed on disk, and rebuilds all nodes. The translation unit in
+        memory is reused which is much faster than a new parse, especially
+        with the 'watch' profile. Falls back to a new parse if the translation
+        unit was loaded from the cache or libclang cannot reparse it. The
+        cache is only updated by new parses.
+
+        :param unsaved_files: If given, replaces the unsaved files passed
+            during initialization.
+        """
+        if self.translation_unit is None:
+            msg = 'A detached parser cannot be reparsed.'
+            raise ValueError(msg)
+        if unsaved_files is not None:
+            self.unsaved_files = list(unsaved_files)
+            self._unsaved_sources = dict((os.path.abspath(name), contents)
+                for name, contents in self.unsaved_files)
+            self.files_to_parse.update(self._unsaved_sources)
+            self._is_local_filename = {}
+        self.stats = ParserStats()
+        with self.stats.timer('parse'):
+            if self.is_loaded_from_cache or not reparse_translation_unit(
+                    self.translation_unit, self.unsaved_files):
+                self._parse_translation_unit()
+        self._process_translation_unit()
+
+    @classmethod
+    def from_string(cls, source, name, extra_files=None, **kwargs):
+        """
+        Parses a header given as a string without reading or writing it from
+        or to disk.
+
+        :param source: The contents of the header.
+        :param name: The filename the header pretends to have. Determines the
+            name of the extern block and how relative includes are resolved.
+        :param extra_files: A dictionary mapping filenames to the contents of
+            further in-memory files, e.g. headers included by source. Relative
+            filenames are relative to the directory of name.
+
+        Only the in-memory files are considered to be part of the library.
+        All further keyword arguments are passed to CFileParser.
+
+        >>> parser = CFileParser.from_string('#include "a.h"\\nint f(a x);',
+        ...     'wrapper.h', extra_files={'a.h': 'typedef int a;'})
+        >>> for line in parser.iter_cython_lines():
+        ...     print line,
+        cdef extern from "wrapper.h" nogil:
+            ctypedef int a
+            int f(a x)
+        """
+        filename = os.path.abspath(name)
+        directory = os.path.dirname(filename)
+        unsaved_files = [(filename, source)]
+        for extra_name, contents in sorted((extra_files or {}).iteritems()):
+            unsaved_files.append((os.path.join(directory, extra_name),
+                                  contents))
+        unsaved_files.extend(kwargs.pop('unsaved_files', None) or [])
+        kwargs.setdefault('local_files', [])
+        return cls(filename, unsaved_files=unsaved_files, **kwargs)
+
+    def _get_include_lines(self, filename):
+        """
+        Returns a dictionary mapping line numbers of a file to the filenames
+        included in these lines. Every file is only read once, files that are
+        not part of the library only once per session.
+        """
+        include_lines_cache = self._include_lines
+        if self.session is not None and not self.is_local_file(filename):
+            include_lines_cache = self.session.include_lines
+        if filename not in include_lines_cache:
+            include_lines = {}
+            for line_number, line in enumerate(
+                    self._read_source(filename).splitlines()):
+                match = INCLUDE_PATTERN.match(line)
+                if match:
+                    include_lines[line_number + 1] = match.group(1)
+            include_lines_cache[filename] = include_lines
+        return include_lines_cache[filename]
+
+    def _read_source(self, filename):
+        """
+        Returns the contents of a source file, preferring unsaved files.
+        """
+        contents = self._unsaved_sources.get(os.path.abspath(filename))
+        if contents is not None:
+            return contents
+        with open(filename, 'r') as open_file:
+            return open_file.read()
+
+    def get_include_spelling(self, filename):
+        """
+        Returns the string used to include the given file, e.g. 'stdint.h'
+        for '/usr/include/stdint.h'.
+
+        The first include directive for the file is used.
+        XXX: I could not find a way to do this within clang. Is there one?
+        """
+        filename = os.path.abspath(filename)
+        if filename in self.include_map:
+            return self.include_map[filename]
+        if self._includes_by_filename is None:
+            self._includes_by_filename = {}
+            for inc in self.includes:
+                self._includes_by_filename.setdefault(
+                    os.path.abspath(inc.include.name), []).append(inc)
+        spelling = None
+        for inc in self._includes_by_filename.get(filename, []):
+            spelling = self._get_include_lines(inc.location.file.name).get(
+                inc.location.line)
+            if spelling:
+                break
+        # Includes spelled with a macro cannot be resolved.
+        if not spelling:
+            spelling = os.path.basename(filename)
+        self.include_map[filename] = spelling
+        return spelling
+
+    def get_include_closure(self):
+        """
+        Returns a sorted list of the absolute paths of the parsed header and
+        all files it includes, directly or indirectly.
+        """
+        if self._include_closure is None:
+            closure = set([os.path.abspath(self.filename)])
+            for include in self.includes:
+                closure.add(os.path.abspath(include.include.name))
+            self._include_closure = sorted(closure)
+        return list(self._include_closure)
 
     def _setup_data_structure(self):
         """
         Create some dictionaries for internal data handling.
         """
-        # While traversing through the ast, collect all occuring types and
-        # store them in one central location to later process them.
-        self.type_collection = []
+        # While traversing through the ast, collect the declarations of all
+        # occuring types and store them in one central location to later
+        # process them. Keyed by (filename, USR or canonical spelling) so every
+        # type is only stored once, no matter how often it is used.
+        self.type_collection = OrderedDict()
+
+        # Cache of the type chains of all resolved types. See
+        # Node.get_type_chain().
+        self.type_chain_cache = {}
 
         # Collect all used names, like struct names, union names, enum names,
         # function names, typedefs and so on to avoid creating duplicate names.
-        self.used_names = []
+        self.used_names = set()
 
         # Sort all top level cursors in one dictionary which will always
         # contain the cursor object.
@@ -119,9 +382,45 @@ class CFileParser(object):
             'unsorted': []
         }
 
+        # The nodes of all top level cursors in the order of the file.
+        self.toplevel_nodes = []
+        # All nodes to be rendered in the final order, e.g. including nested
+        # nodes. Filled by resolve_nodes().
         self.all_parsed_nodes = []
         self.unsorted_nodes = []
 
+        # Collects the names of the types a node depends on while it is being
+        # parsed. See Node.parse().
+        self.dependency_stack = []
+
+        # Map the hashes of cursors to the one node created for them. Always
+        # use get_or_create_node() and get_registered_node() to access it.
+        self.node_registry = {}
+
+    def get_registered_node(self, cursor):
+        """
+        Returns the node registered for a cursor or None.
+        """
+        node = self.node_registry.get(cursor.hash)
+        # Guard against hash collisions.
+        if node is None or not node.node == cursor:
+            return None
+        return node
+
+    def get_or_create_node(self, cursor, node_class, **kwargs):
+        """
+        Returns a tuple (node, created). node is the node registered for the
+        cursor. If there is none yet, a new node of type node_class is created,
+        registered and created is True.
+        """
+        node = self.get_registered_node(cursor)
+        if node is not None:
+            return node, False
+        node = node_class(cursor, parser=self, **kwargs)
+        # Never replace a node registered under the same hash.
+        self.node_registry.setdefault(cursor.hash, node)
+        return node, True
+
     def _sort_toplevel_nodes(self):
         """
         Sort all toplevel nodes in the corresponding lists in
@@ -136,70 +435,179 @@ class CFileParser(object):
         #       pass
         # Therefore the typedef will be omitted in this case because it is not
         # needed (nor possible to assign) in Cython.
-        self.type_names = []
+        self.type_names = set()
 
         # Loop through all top level nodes and sort them by CursorKind.
         for cursor in self.cursor.get_children():
             # Filter out all nodes that do not have their origin in a file in
             # the same directory as the root header file.
-            if not cursor.location.file or \
-                not (os.path.abspath(cursor.location.file.name) in \
-                self.files_to_parse):
+            location_file = cursor.location.file
+            if location_file is None:
+                continue
+            # Looking up the address of the file object avoids querying and
+            # normalizing the filename for every cursor.
+            file_address = addressof(location_file.obj.contents)
+            is_local = self._is_local_file_object.get(file_address)
+            if is_local is None:
+                is_local = self.is_local_file(location_file.name)
+                self._is_local_file_object[file_address] = is_local
+            if not is_local:
                 continue
             # Get the kind of the current node and sort them in the
             # provided lists.
             kind = cursor.kind
-            if kind == CursorKind.TYPEDEF_DECL:
-                self.all_parsed_nodes.append(TypedefNode(cursor, parser=self))
-            elif kind == CursorKind.FUNCTION_DECL:
-                self.all_parsed_nodes.append(FunctionProtoNode(cursor,
-                                                               parser=self))
-            elif kind == CursorKind.STRUCT_DECL:
-                node = StructNode(cursor, parser=self)
-                self.type_names.append(node.node_name)
-                self.all_parsed_nodes.append(node)
-            elif kind == CursorKind.UNION_DECL:
-                node = UnionNode(cursor, parser=self)
-                self.type_names.append(node.node_name)
-                self.all_parsed_nodes.append(node)
-            elif kind == CursorKind.ENUM_DECL:
-                node = EnumNode(cursor, parser=self)
-                self.type_names.append(node.node_name)
-                self.all_parsed_nodes.append(node)
+            if kind in TOPLEVEL_NODE_CLASSES:
+                # The nodes are parsed in resolve_nodes(), unless lazy right
+                # afterwards.
+                node, created = self.get_or_create_node(cursor,
+                    TOPLEVEL_NODE_CLASSES[kind], lazy=True)
+                if not created:
+                    continue
+                if kind != CursorKind.TYPEDEF_DECL and \
+                   kind != CursorKind.FUNCTION_DECL:
+                    self.type_names.add(node.node_name)
+                self.toplevel_nodes.append(node)
             elif kind == CursorKind.MACRO_DEFINITION:
                 node = MacroDefinitionNode(cursor, parser=self)
                 # Only append #define constants and no macros. These need to be
                 # defined by hand due to unresolvable type issues.
                 if node.is_define_constant is True:
-                    self.all_parsed_nodes.append(node)
+                    self.toplevel_nodes.append(node)
             else:
                 self.unsorted_nodes.append(cursor)
 
+    def resolve_nodes(self):
+        """
+        Parse all nodes that are not parsed yet and determine the external
+        types they use. Automatically called before rendering.
+        """
+        if self.is_resolved:
+            return
+        with self.stats.timer('resolve'):
+            selected_nodes = None
+            if self.symbols is not None:
+                selected_nodes = self.get_symbol_closure(self.symbols)
+            self.all_parsed_nodes = []
+            for node in self.toplevel_nodes:
+                if selected_nodes is not None and node not in selected_nodes:
+                    continue
+                node.parse()
+                self._append_with_nested_nodes(node)
+        with self.stats.timer('external_types'):
+            self.parse_external_types()
+        self.is_resolved = True
+
+    def _append_with_nested_nodes(self, node):
+        """
+        Append a node to self.all_parsed_nodes. Its nested nodes come first.
+        """
+        for nested_node in node.nested_nodes:
+            self._append_with_nested_nodes(nested_node)
+        self.all_parsed_nodes.append(node)
+
+    def get_symbol_closure(self, symbols):
+        """
+        Returns the set of all top level nodes whose names match one of the
+        given names or glob patterns plus all top level nodes they depend on,
+        directly or indirectly. Parses all of them on the way.
+        """
+        nodes_by_name = {}
+        for node in self.toplevel_nodes:
+            nodes_by_name.setdefault(node.node_name, []).append(node)
+        # Named structs and unions declared inside of another one only become
+        # nodes once the outer one is parsed. Select the outer one for them,
+        # they are rendered as its nested nodes.
+        for node in self.toplevel_nodes:
+            if isinstance(node, StructOrUnionNode):
+                for name in self._iter_nested_record_names(node.node):
+                    nodes_by_name.setdefault(name, []).append(node)
+        pending = [name for name in nodes_by_name if
+                   any(fnmatchcase(name, pattern) for pattern in symbols)]
+        selected_nodes = set()
+        while pending:
+            for node in nodes_by_name.get(pending.pop(), []):
+                if node in selected_nodes:
+                    continue
+                selected_nodes.add(node)
+                node.parse()
+                pending.extend(node.dependencies)
+        return selected_nodes
+
+    def _iter_nested_record_names(self, cursor):
+        """
+        Yields the names of all named structs and unions declared inside of
+        the given struct or union cursor, at any depth.
+        """
+        for child in cursor.get_children():
+            if child.kind == CursorKind.STRUCT_DECL or \
+               child.kind == CursorKind.UNION_DECL:
+                if child.spelling:
+                    yield child.spelling
+                for name in self._iter_nested_record_names(child):
+                    yield name
+
+    def is_local_file(self, filename):
+        """
+        Returns True if the file is part of the library, e.g. it is in the
+        directory of the parsed header.
+        """
+        is_local = self._is_local_filename.get(filename)
+        if is_local is None:
+            is_local = os.path.abspath(filename) in self.files_to_parse
+            self._is_local_filename[filename] = is_local
+        return is_local
+
+    def add_dependency(self, name):
+        """
+        Record that the node currently being parsed depends on the type with
+        the given name.
+        """
+        if self.dependency_stack and name:
+            self.dependency_stack[-1].add(name)
+
+    def add_type_to_collection(self, type_kind):
+        """
+        Add the declaration of a type to the type collection unless it already
+        is in it. Returns the (key, declaration, name) tuple used for the type
+        collection or None for types without declaration.
+        """
+        declaration = type_kind.get_declaration()
+        # Native types have no declaration.
+        if declaration.location.file is None:
+            return None
+        key = (declaration.location.file.name, declaration.get_usr() or
+               declaration.type.get_canonical().spelling)
+        name = declaration.spelling
+        self.add_type_collection_entry(key, declaration, name)
+        return key, declaration, name
+
+    def add_type_collection_entry(self, key, declaration, name):
+        self.add_dependency(name)
+        if key not in self.type_collection:
+            self.type_collection[key] = declaration
+
     def parse_external_types(self):
-        self.sorted_external_types = {}
-        # Sort by origin file
-        for e_type in self.type_collection:
-            e_type = e_type.get_declaration()
+        self.sorted_external_types = OrderedDict()
+        # Sort by origin file. The type collection does not contain any
+        # duplicates.
+        for (include_path, _), e_type in self.type_collection.iteritems():
             # Do not consider files that are part of the library and parsed
             # anyway.
-            if e_type.location.file is None:
-                continue
-            include_path = e_type.location.file.name
-            if os.path.abspath(include_path) in self.files_to_parse:
+            if self.is_local_file(include_path):
                 continue
-            if include_path not in self.sorted_external_types:
-                self.sorted_external_types[include_path] = []
-            if e_type not in self.sorted_external_types[include_path]:
-                self.sorted_external_types[include_path].append(e_type)
+            self.sorted_external_types.setdefault(include_path, []).append(
+                e_type)
+        self.stats.external_types = sum(len(_i) for _i in
+                                        self.sorted_external_types.itervalues())
 
-    def render_external_types(self, file_object):
+    def _get_external_blocks(self):
+        """
+        Returns one ir.ExternalBlock for every external header types are used
+        from.
+        """
+        blocks = []
         for key, value in self.sorted_external_types.iteritems():
-            try:
-                self.include_map[key]
-            except:
-                from IPython.core.debugger import Tracer; Tracer()()
-            file_object.write('cdef extern from "%s" nogil:\n' % \
-                              self.include_map[key])
+            declarations = []
             # XXX: Currently only works with typedef nodes, but I think that
             # covers most uses. Will raise a more or less meaningful error if
             # an unexpected node arrives.
@@ -218,45 +626,181 @@ class CFileParser(object):
                         org_name = 'enum'
                     else:
                         raise NotImplementedError
-                    file_object.write('%scdef %s %s:\n%s%spass\n' % \
-                        (TAB, org_name, org_decl.spelling, TAB, TAB))
-                # Write the actual typedef.
-                file_object.write('%s%s\n' % (TAB, node.get_cython_string()))
-            # Write one empty line at the end.
-            file_object.write('\n')
-
-    def render_cython_header(self, filename_or_object):
-        if isinstance(filename_or_object, basestring):
-            with open(filename_or_object, 'w') as file_object:
-                self._render_cython_header(file_object)
-            return
-        self._render_cython_header(filename_or_object)
+                    declarations.append(Opaque(org_decl.spelling,
+                        filename=key, specifier=org_name))
+                # The actual typedef.
+                declarations.append(self._get_declaration(node))
+            blocks.append(ExternalBlock(self.get_include_spelling(key),
+                                        tuple(declarations), key))
+        return tuple(blocks)
 
-    def render_va_list_header(self, filename_or_object):
+    @staticmethod
+    def _get_declaration(node):
         """
-        The va_list type is implementation specific. The current way should
-        work with gcc and is untested with other compilers. va_start, va_end,
-        ... are currently not supported because they are probably not used very
-        much in C header files.
+        Returns the ir.Declaration of a parsed node, knowing its file and
+        dependencies.
         """
-        if not hasattr(self, 'is_va_list_used') or not self.is_va_list_used:
-            return
-        filename_or_object.write('cdef extern from "stdarg.h" nogil:\n' + \
-                                 '%sctypedef void *va_list\n\n' % TAB)
-
-    def _render_cython_header(self, file_object):
-        self.render_external_types(file_object)
-        self.render_va_list_header(file_object)
+        declaration = node.get_ir()
+        location_file = node.node.location.file
+        declaration.filename = location_file.name if location_file else None
+        declaration.dependencies = frozenset(node.dependencies)
+        return declaration
 
-        file_object.write('cdef extern from "%s" nogil:\n' % \
-                          os.path.basename(self.filename))
+    def get_ir(self):
+        """
+        Returns the parsed header as an ir.Header. It contains everything
+        needed to render the Cython definition file but does not refer to
+        libclang anymore.
+        """
+        if self.ir is not None:
+            return self.ir
+        self.resolve_nodes()
+        external_blocks = self._get_external_blocks()
+        declarations = []
         for node in self.all_parsed_nodes:
             # Do not typedef already defined names. Mainly occurring if some
             # structure has the same name as a typedef to it.
             if isinstance(node, TypedefNode) and node.node_name in \
                 self.type_names:
                 continue
-            cython_string = node.get_cython_string().splitlines(True)
-            for line in cython_string:
-                file_object.write('%s%s' % (TAB, line))
-            file_object.write('\n')
+            declarations.append(self._get_declaration(node))
+        # The spellings are needed to split the header and cannot be
+        # determined anymore once the translation unit is gone.
+        filenames = set(os.path.abspath(_i.filename) for _i in declarations
+                        if _i.filename is not None)
+        filenames.discard(os.path.abspath(self.filename))
+        self.ir = Header(os.path.basename(self.filename), external_blocks,
+                         self.is_va_list_used,
+                         tuple(declarations), None,
+                         tuple((_i, self.get_include_spelling(_i)) for _i in
+                               sorted(filenames)) or None)
+        return self.ir
+
+    def detach(self):
+        """
+        Builds the intermediate representation and drops the translation unit
+        and everything else referring to libclang. Afterwards, the parser can
+        still be rendered but not queried for nodes anymore. Returns the
+        ir.Header.
+        """
+        header = self.get_ir()
+        self.get_include_closure()
+        self.translation_unit = None
+        self.cursor = None
+        self.includes = []
+        self._includes_by_filename = None
+        self._setup_data_structure()
+        self.sorted_external_types = OrderedDict()
+        return header
+
+    def dump(self, filename):
+        """
+        Writes the intermediate representation to a snapshot file. It can be
+        loaded and rendered with head2cydef.snapshot.load() without libclang.
+        """
+        snapshot.dump(self.get_ir(), filename, self.get_include_closure())
+
+    def iter_external_type_lines(self):
+        """
+        Yields the lines of the extern blocks of all external types.
+        """
+        return self.get_ir().iter_external_type_lines()
+
+    def render_external_types(self, file_object):
+        file_object.writelines(self.iter_external_type_lines())
+
+    def iter_va_list_lines(self):
+        """
+        The va_list type is implementation specific. The current way should
+        work with gcc and is untested with other compilers. va_start, va_end,
+        ... are currently not supported because they are probably not used very
+        much in C header files.
+        """
+        return self.get_ir().iter_va_list_lines()
+
+    def render_va_list_header(self, filename_or_object):
+        filename_or_object.writelines(self.iter_va_list_lines())
+
+    def iter_cython_lines(self):
+        """
+        Yields the Cython definition file line by line. Every line ends with a
+        newline character.
+
+        The lines are assembled from the intermediate representation one at a
+        time, so it can be written directly to a file, pipe or socket, e.g.
+
+            output_file.writelines(parser.iter_cython_lines())
+
+        Only the output is never held in memory as a whole. The translation
+        unit, the nodes and the intermediate representation are kept until
+        detach() is called.
+
+        The time spent in here, including the time the consumer needs to
+        handle the lines, is recorded as the render phase in self.stats.
+        """
+        self.resolve_nodes()
+        start = time.time()
+        self.stats.output_lines = 0
+        try:
+            for line in self.get_ir().iter_cython_lines():
+                self.stats.output_lines += 1
+                yield line
+        finally:
+            self.stats.add_time('render', time.time() - start)
+
+    def render_cython_header(self, filename_or_object, only_if_changed=False):
+        """
+        Writes the Cython definition file to a filename or file-like object.
+
+        If only_if_changed is True and a filename is given, the file is only
+        replaced if its content changes, see utils.write_if_changed(). Returns
+        whether or not the file was written.
+        """
+        if isinstance(filename_or_object, basestring):
+            if only_if_changed:
+                return write_if_changed(filename_or_object,
+                                        self.iter_cython_lines())
+            with open(filename_or_object, 'w') as file_object:
+                self._render_cython_header(file_object)
+            return True
+        self._render_cython_header(filename_or_object)
+        return True
+
+    def _render_cython_header(self, file_object):
+        file_object.writelines(self.iter_cython_lines())
+
+    def render_split_cython_headers(self, filename, only_if_changed=False,
+                                    package=None):
+        """
+        Writes one Cython definition file per header the declarations are in,
+        see split.split_header(). The definitions of the parsed header itself
+        are written to filename, all others to files named after their header
+        in the same directory.
+
+        Returns an OrderedDict mapping all written filenames to whether or not
+        they changed. Raises a ValueError if two headers would be written to
+        the same file.
+        """
+        directory = os.path.dirname(filename)
+        root_module = get_module_name(filename)
+        headers = split_header(self.get_ir(), root_module, package,
+                               root_filename=os.path.abspath(self.filename))
+        # The other files can only cimport from filename if it is named after
+        # its module.
+        if root_module != os.path.splitext(os.path.basename(filename))[0]:
+            for header in headers.values()[1:]:
+                if any(_i.module.split('.')[-1] == root_module for _i in
+                       header.cimports or ()):
+                    msg = ('%s is cimported from other files and thus has to '
+                           'be a valid module name, e.g. %s.pxd.') % (
+                           filename, root_module)
+                    raise ValueError(msg)
+        written = OrderedDict()
+        for index, (module, header) in enumerate(headers.iteritems()):
+            if index == 0:
+                output = filename
+            else:
+                output = os.path.join(directory, module + '.pxd')
+            written[output] = header.render_cython_header(output,
+                                                          only_if_changed)
+        return written
@@ -1,6 +1,9 @@
 from clang.cindex import TypeKind
 
-TAB = 4 * ' '
+# TAB and indent_line used to be defined here. Re-exported so code importing
+# them from this module keeps working.
+from ir import TAB, indent_line  # NOQA
+
 
 # Map the clang.cindex.TypeKinds to how it would be written in Code. Not all
 # types are exposed yet.
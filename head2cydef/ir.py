@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Intermediate representation of a parsed header.
+
+The records only consist of strings, numbers and tuples and do not refer to
+libclang in any way. Once created, the translation unit is no longer needed
+to render the Cython definition file and the records can be pickled and sent
+to other processes.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from utils import write_atomically, write_if_changed
+
+
+TAB = 4 * ' '
+
+
+def indent_line(line):
+    """
+    Indents a line by one level. Empty lines stay empty.
+
+    >>> indent_line('int a\\n')
+    '    int a\\n'
+    >>> indent_line('\\n')
+    '\\n'
+    """
+    if line == '\n':
+        return line
+    return TAB + line
+
+
+def assemble_type_string(type_chain, type_string=''):
+    """
+    Takes a type chain as returned by Node.get_type_chain() and assembles a
+    string from it.
+
+    >>> type_chain = ['__pointer__', 'int']
+    >>> print assemble_type_string(type_chain)
+    int *
+
+    If type_string is given it will be inserted as if it is the name given
+    during a typedef, e.g.
+    >>> type_chain = [('__array__', 10), '__pointer__', ('__array__', 5), 'int']
+    >>> print assemble_type_string(type_chain, type_string='cmplxIntType')
+    int (*cmplxIntType[10])[5]
+    """
+    previous_type = None
+    for item in type_chain:
+        # Array.
+        if isinstance(item, tuple) and item[0] == '__array__':
+            # Set brackets if necessary.
+            if previous_type == '__pointer__':
+                type_string = '(%s)' % type_string
+            type_string += '[%i]' % item[1]
+        # Pointer.
+        elif item == '__pointer__':
+            type_string = '*' + type_string
+        elif isinstance(item, basestring):
+            type_string = '%s %s' % (item, type_string)
+        else:
+            msg = 'Invalid type chain item: %s' % repr(item)
+            raise ValueError(msg)
+        previous_type = item
+    return type_string
+
+
+def _intern(value):
+    """
+    Interns all strings, also the ones in tuples and frozensets, so the many
+    repeated type and field names only exist once in memory.
+    """
+    if isinstance(value, str):
+        return intern(value)
+    if isinstance(value, tuple):
+        return tuple(_intern(_i) for _i in value)
+    if isinstance(value, frozenset):
+        return frozenset(_intern(_i) for _i in value)
+    return value
+
+
+class Record(object):
+    """
+    Base class of all records. The fields are the __slots__ of the class and
+    all its base classes. Fields not given during initialization are None.
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        fields = self._get_fields()
+        if len(args) > len(fields):
+            msg = '%s takes at most %i arguments.' % (
+                self.__class__.__name__, len(fields))
+            raise TypeError(msg)
+        values = dict(zip(fields, args))
+        for key, value in kwargs.iteritems():
+            if key not in fields:
+                msg = '%s has no field %s.' % (self.__class__.__name__, key)
+                raise TypeError(msg)
+            values[key] = value
+        for field in fields:
+            setattr(self, field, _intern(values.get(field)))
+
+    @classmethod
+    def _get_fields(cls):
+        fields = []
+        for klass in reversed(cls.__mro__):
+            fields.extend(getattr(klass, '__slots__', ()))
+        return fields
+
+    # Classes with __slots__ need these to be pickled with protocols < 2.
+    def __getstate__(self):
+        return tuple(getattr(self, _i) for _i in self._get_fields())
+
+    def __setstate__(self, state):
+        for field, value in zip(self._get_fields(), state):
+            setattr(self, field, _intern(value))
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and \
+            self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (_i, getattr(self, _i)) for _i in self._get_fields()))
+
+    def get_cython_string(self):
+        raise NotImplementedError
+
+    def iter_cython_lines(self):
+        """
+        Yields the lines of the Cython string, each terminated by a newline.
+        """
+        for line in self.get_cython_string().split('\n'):
+            yield line + '\n'
+
+
+class Field(Record):
+    """
+    A struct or union field or any other name with a type chain.
+
+    >>> print Field('values', (('__array__', 4), 'int')).get_cython_string()
+    int values[4]
+    """
+    __slots__ = ('name', 'chain')
+
+    def get_cython_string(self):
+        return assemble_type_string(self.chain, self.name).strip()
+
+
+class Param(Record):
+    """
+    A function parameter.
+
+    >>> print Param('data', ('__pointer__', 'void')).get_cython_string()
+    void *data
+    """
+    __slots__ = ('name', 'chain')
+
+    def get_type_string(self):
+        return assemble_type_string(self.chain).strip()
+
+    def get_cython_string(self):
+        # Some formatting issues. Does not really change anything else.
+        return ('%s %s' % (self.get_type_string(), self.name)).replace(' * ',
+                                                                      ' *')
+
+
+class FunctionPointer(Record):
+    """
+    A function pointer, e.g. a field, a parameter or the target of a typedef.
+    params is a tuple of Param records.
+
+    >>> print FunctionPointer('callback', ('int',),
+    ...     (Param('data', ('__pointer__', 'void')),)).get_cython_string()
+    int (*callback)(void* data)
+    """
+    __slots__ = ('name', 'return_chain', 'params')
+
+    def get_cython_string(self):
+        params = []
+        for param in self.params:
+            # Fix some pure formatting issues with spaces between pointer
+            # declarations and with unnamed parameters.
+            params.append(('%s %s' % (param.get_type_string().replace(' *',
+                '*'), param.name)).strip())
+        return '%s (*%s)(%s)' % (
+            assemble_type_string(self.return_chain).strip(), self.name,
+            ', '.join(params))
+
+
+class Declaration(Record):
+    """
+    Base class of all top level declarations. filename is the file the
+    declaration is in and dependencies the names of all types it uses.
+    """
+    __slots__ = ('name', 'filename', 'dependencies')
+
+    def __init__(self, *args, **kwargs):
+        Record.__init__(self, *args, **kwargs)
+        if self.dependencies is None:
+            self.dependencies = frozenset()
+
+
+class Macro(Declaration):
+    """
+    A #define constant.
+    """
+    __slots__ = ()
+
+    def get_cython_string(self):
+        return 'enum: %s' % self.name
+
+
+class Typedef(Declaration):
+    """
+    A typedef. type is either a type chain or a FunctionPointer record.
+
+    >>> print Typedef('new_int', type=('__pointer__', 'int')).get_cython_string()
+    ctypedef int *new_int
+    """
+    __slots__ = ('type',)
+
+    def get_cython_string(self):
+        if isinstance(self.type, FunctionPointer):
+            return 'ctypedef %s' % self.type.get_cython_string()
+        return 'ctypedef %s' % assemble_type_string(self.type,
+                                                    self.name).strip()
+
+
+class StructOrUnion(Declaration):
+    """
+    A struct or union. specifier is either 'struct' or 'union' and fields a
+    tuple of Field and FunctionPointer records.
+    """
+    __slots__ = ('specifier', 'fields')
+
+    def get_cython_string(self):
+        fields = ['%s%s' % (TAB, _i.get_cython_string()) for _i in
+                  self.fields]
+        if not fields:
+            fields.append('%spass' % TAB)
+        return 'cdef %s %s:\n%s' % (self.specifier, self.name,
+                                    '\n'.join(fields))
+
+
+class Opaque(Declaration):
+    """
+    A struct, union or enum of which only the name is known.
+    """
+    __slots__ = ('specifier',)
+
+    def get_cython_string(self):
+        return 'cdef %s %s:\n%spass' % (self.specifier, self.name, TAB)
+
+
+class Enum(Declaration):
+    """
+    An enum. constants is a tuple of the names of all constants.
+    """
+    __slots__ = ('constants',)
+
+    def get_cython_string(self):
+        return 'cdef enum %s:\n%s' % (self.name, '\n'.join(
+            '%s%s' % (TAB, _i) for _i in self.constants))
+
+
+class Function(Declaration):
+    """
+    A function prototype. params is a tuple of Param and FunctionPointer
+    records.
+    """
+    __slots__ = ('return_chain', 'params')
+
+    def get_cython_string(self):
+        # XXX: Hacky
+        return_type = assemble_type_string(self.return_chain).strip().replace(
+            ' ', '')
+        return '%s %s(%s)' % (return_type, self.name, ', '.join(
+            _i.get_cython_string() for _i in self.params))
+
+
+class ExternalBlock(Record):
+    """
+    The declarations of all types used from one external header. include is
+    the string the header is included with and filename its path.
+    """
+    __slots__ = ('include', 'declarations', 'filename')
+
+
+class Cimport(Record):
+    """
+    Names cimported from another Cython definition file.
+
+    >>> print Cimport('other', ('a', 'b')).get_cython_string()
+    from other cimport a, b
+    """
+    __slots__ = ('module', 'names')
+
+    def get_cython_string(self):
+        return 'from %s cimport %s' % (self.module, ', '.join(self.names))
+
+
+class Header(Record):
+    """
+    A complete parsed header, everything needed to write the Cython definition
+    file. cimports is an optional tuple of Cimport records and
+    include_spellings an optional tuple of (filename, spelling) pairs with
+    the string every other file declarations are in is included with.
+
+    >>> header = Header('some.h', (), False, (Macro('SOME_CONSTANT'),))
+    >>> for line in header.iter_cython_lines():
+    ...     print line,
+    cdef extern from "some.h" nogil:
+        enum: SOME_CONSTANT
+    """
+    __slots__ = ('name', 'external_blocks', 'is_va_list_used',
+                 'declarations', 'cimports', 'include_spellings')
+
+    def iter_external_type_lines(self):
+        for block in self.external_blocks:
+            yield 'cdef extern from "%s" nogil:\n' % block.include
+            for declaration in block.declarations:
+                for line in declaration.iter_cython_lines():
+                    yield indent_line(line)
+            # One empty line at the end.
+            yield '\n'
+
+    def iter_va_list_lines(self):
+        """
+        The va_list type is implementation specific. The current way should
+        work with gcc and is untested with other compilers.
+        """
+        if not self.is_va_list_used:
+            return
+        yield 'cdef extern from "stdarg.h" nogil:\n'
+        yield '%sctypedef void *va_list\n' % TAB
+        yield '\n'
+
+    def iter_cython_lines(self):
+        if self.cimports:
+            for cimport in self.cimports:
+                for line in cimport.iter_cython_lines():
+                    yield line
+            yield '\n'
+        for line in self.iter_external_type_lines():
+            yield line
+        for line in self.iter_va_list_lines():
+            yield line
+        yield 'cdef extern from "%s" nogil:\n' % self.name
+        for declaration in self.declarations:
+            for line in declaration.iter_cython_lines():
+                yield indent_line(line)
+        # An empty block is not valid Cython.
+        if not self.declarations:
+            yield '%spass\n' % TAB
+
+    def render_cython_header(self, filename_or_object, only_if_changed=False):
+        """
+        See CFileParser.render_cython_header().
+        """
+        if isinstance(filename_or_object, basestring):
+            if only_if_changed:
+                return write_if_changed(filename_or_object,
+                                        self.iter_cython_lines())
+            # Concurrent workers might write the same split file.
+            write_atomically(filename_or_object,
+                             ''.join(self.iter_cython_lines()))
+            return True
+        filename_or_object.writelines(self.iter_cython_lines())
+        return True
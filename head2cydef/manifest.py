@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent manifest of generated files and the headers they depend on. Used
+to only regenerate outputs whose include closure changed.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import json
+import os
+import tempfile
+
+from utils import get_file_hash
+
+
+class Manifest(object):
+    """
+    Records, for every generated output file, the header it was generated
+    from, the settings used and the modification time and hash of every file
+    in the header's include closure and of every generated file, e.g. also
+    the further files written with split.
+
+    Modification times are checked first. Only if one changed, the file's
+    hash is compared, so touching a header without changing it does not
+    trigger a regeneration.
+    """
+    VERSION = 2
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.outputs = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as file_object:
+                content = json.load(file_object)
+            # Silently start over with manifests written by other versions.
+            if content.get('version') == self.VERSION:
+                self.outputs = content['outputs']
+
+    @staticmethod
+    def _get_settings_string(settings):
+        return json.dumps(settings or {}, sort_keys=True)
+
+    @staticmethod
+    def _get_file_states(filenames):
+        files = {}
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            files[filename] = [os.path.getmtime(filename),
+                               get_file_hash(filename)]
+        return files
+
+    @staticmethod
+    def _are_unchanged(files):
+        """
+        Returns True if all files still exist with the recorded content.
+        """
+        for filename, (mtime, file_hash) in files.iteritems():
+            try:
+                current_mtime = os.path.getmtime(filename)
+            except OSError:
+                return False
+            if current_mtime == mtime:
+                continue
+            if get_file_hash(filename) != file_hash:
+                return False
+            # Same content. Store the new time to avoid hashing it again.
+            files[filename][0] = current_mtime
+        return True
+
+    def is_up_to_date(self, header, output, settings=None):
+        """
+        Returns True if output was generated from header with the same
+        settings and neither any generated file nor any file in the include
+        closure changed or was removed since then.
+        """
+        output = os.path.abspath(output)
+        entry = self.outputs.get(output)
+        if entry is None or not os.path.exists(output):
+            return False
+        if entry['header'] != os.path.abspath(header) or \
+           entry['settings'] != self._get_settings_string(settings):
+            return False
+        return self._are_unchanged(entry['generated']) and \
+            self._are_unchanged(entry['files'])
+
+    def update(self, header, output, dependencies, settings=None,
+               generated=None):
+        """
+        Record the include closure of a freshly generated output file.
+        generated are all files written for it and defaults to output.
+        """
+        if generated is None:
+            generated = [output]
+        self.outputs[os.path.abspath(output)] = {
+            'header': os.path.abspath(header),
+            'settings': self._get_settings_string(settings),
+            'files': self._get_file_states(dependencies),
+            'generated': self._get_file_states(generated)}
+
+    def remove(self, output):
+        self.outputs.pop(os.path.abspath(output), None)
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, temp_filename = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as file_object:
+            json.dump({'version': self.VERSION, 'outputs': self.outputs},
+                      file_object, indent=1, sort_keys=True)
+        os.rename(temp_filename, self.filename)
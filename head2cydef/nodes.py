@@ -1,7 +1,10 @@
 from clang.cindex import TypeKind, CursorKind, Type
-import random
+import os
 
-from header import TYPE_KIND_MAP, TAB
+from header import TYPE_KIND_MAP
+from ir import assemble_type_string, Enum, Field, Function, FunctionPointer, \
+    Macro, Param, StructOrUnion, Typedef
+from utils import get_string_hash
 
 
 class clangParserGenericError(Exception):
@@ -15,6 +18,16 @@ class clangParserWrongNodeKindError(clangParserGenericError):
 class Node(object):
     """
     Base class for all Node parsers.
+
+    Nodes created with lazy=True only get a name during initialization. The
+    actual parsing happens the first time the node is rendered or parse() is
+    called.
+
+    After parsing, self.dependencies contains the names of all types the node
+    refers to and self.nested_nodes all nested structs and unions that were
+    created while parsing it. These have to be rendered before the node.
+    self.ir is the parsed node as a record of the intermediate representation,
+    see ir.py. The Cython string is rendered from it.
     """
     def __init__(self, node, parser=None, *args, **kwargs):
         # Give easy access to the central parser class and some attributes of
@@ -22,19 +35,44 @@ class Node(object):
         self.file_parser = parser
         self.files_to_parse = parser.files_to_parse
         self.used_names = parser.used_names
+        parser.stats.count_node(self)
 
         self.node = node
         self.node_name = self.node.spelling
         # If the node has no name, e.g. in a nested struct, or a direct typedef
-        # assign a random one to it, so it can be referenced to.
+        # assign a generated one to it, so it can be referenced to.
         if not self.node_name:
-            self.set_random_node_name()
+            self.set_anonymous_node_name()
         # Append the name of the current node to it.
-        self.used_names.append(self.node_name)
+        self.used_names.add(self.node_name)
+
+        self.dependencies = set()
+        self.nested_nodes = []
 
-        # Always parse the node during initialization and assemble the Cython
-        # string.
-        self._parse_node()
+        # Unless lazy, parse the node during initialization and assemble the
+        # Cython string.
+        self.is_parsed = False
+        if not kwargs.get('lazy', False):
+            self.parse()
+
+    def parse(self):
+        """
+        Parse the node and assemble the Cython string if not done yet.
+        """
+        if self.is_parsed:
+            return
+        self.is_parsed = True
+        # All dependencies found while parsing are added to the set on top of
+        # the stack. Nodes created while parsing this one push their own set,
+        # which is merged into this one afterwards.
+        dependency_stack = self.file_parser.dependency_stack
+        dependency_stack.append(self.dependencies)
+        try:
+            self._parse_node()
+        finally:
+            dependency_stack.pop()
+        if dependency_stack:
+            dependency_stack[-1].update(self.dependencies)
 
     def _add_type_to_collection(self, type_kind):
         """
@@ -43,38 +81,62 @@ class Node(object):
         if not isinstance(type_kind, Type):
             msg = "Not a clang.cindex.Type instance."
             raise TypeError(msg)
-        # Store as (file_path
-        self.file_parser.type_collection.append(type_kind)
+        return self.file_parser.add_type_to_collection(type_kind)
 
     def _parse_node(self):
         raise NotImplementedError
 
+    def get_ir(self):
+        self.parse()
+        return self.ir
+
     def get_cython_string(self, *args, **kwargs):
-        return self.cython_string
+        return self.get_ir().get_cython_string()
+
+    @property
+    def cython_string(self):
+        return self.get_cython_string()
+
+    def iter_cython_lines(self):
+        """
+        Yields the lines of the Cython string, each terminated by a newline.
+        """
+        return self.get_ir().iter_cython_lines()
 
     def __str__(self):
         return self.get_cython_string()
 
-    def set_random_node_name(self):
+    def set_anonymous_node_name(self):
         """
-        Set a random node_name in one of the following forms:
-            Struct_random_462343461
-            Union_random_462343461
-            Enum_random_462343461
-        This will check with the file parser to avoid accidentically creating
-        duplicate names.
+        Set a generated node_name in one of the following forms:
+            Struct_anonymous_3f2a9c
+            Union_anonymous_3f2a9c
+            Enum_anonymous_3f2a9c
+        The suffix is derived from the USR of the node or, if it has none,
+        from its file and offset, so the same header always results in the
+        same names. This will check with the file parser to avoid
+        accidentically creating duplicate names.
         """
-        # Loop until a previously untaken name is found.
+        # Assemble the prefix based on the class name.
+        prefix = self.__class__.__name__.lower()
+        prefix = prefix.replace('node', '')
+        prefix = prefix.capitalize()
+        identifier = self.node.get_usr()
+        if not identifier:
+            location = self.node.location
+            filename = location.file.name if location.file else ''
+            identifier = '%s@%i' % (os.path.basename(filename),
+                                    location.offset)
+        # Only loops again in the unlikely case of a collision.
+        counter = 0
         while True:
-            # Assemble the new name based on the class name.
-            class_name = self.__class__.__name__.lower()
-            class_name = class_name.replace('node', '')
-            class_name = class_name.capitalize()
-            class_name += '_temp_random_%06i' % random.randint(0, 999999)
-            if class_name not in self.used_names:
+            node_name = '%s_anonymous_%s' % (prefix,
+                get_string_hash(identifier, str(counter))[:6])
+            if node_name not in self.used_names:
                 break
-        self.node_name = class_name
-        self.used_names.append(self.node_name)
+            counter += 1
+        self.node_name = node_name
+        self.used_names.add(self.node_name)
 
     def get_type_chain(self, type_node, type_chain):
         """
@@ -97,33 +159,62 @@ class Node(object):
         Due to the recursive nature of the function and Python storing
         references of function parameters over calls, an initial type_chain has
         to be given to the method. This usually is just an empty list.
+
+        The file parser caches the chain of every type together with the
+        entries it added to the type collection, so resolving the same type
+        again is a dictionary lookup.
         """
         # Small sanity check.
         if not isinstance(type_node.kind, TypeKind):
             msg = 'type_node.kind is not of type TypeKind.'
             raise TypeError(msg)
+        cache = self.file_parser.type_chain_cache
+        # The spelling is not enough to identify a type, e.g. the canonical
+        # type of a pointer to a typedef'ed anonymous struct has the same
+        # spelling as the pointer to the typedef.
+        spelling = type_node.spelling
+        key = (type_node.kind.value, spelling,
+               type_node == type_node.get_canonical())
+        if spelling and key in cache:
+            chain, collection_entries = cache[key]
+            for entry in collection_entries:
+                self.file_parser.add_type_collection_entry(*entry)
+        else:
+            chain, collection_entries = [], []
+            self._build_type_chain(type_node, chain, collection_entries)
+            chain = tuple(chain)
+            if spelling:
+                cache[key] = (chain, tuple(collection_entries))
+        type_chain.extend(chain)
+        return type_chain
+
+    def _build_type_chain(self, type_node, type_chain, collection_entries):
+        """
+        Does the actual work for get_type_chain(). All entries added to the
+        type collection are appended to collection_entries.
+        """
         # A native type is mapped via a dictionary lookup.
         if type_node.kind in TYPE_KIND_MAP:
             type_chain.append(TYPE_KIND_MAP[type_node.kind])
         # Store an eventual pointer and recursivly call the function.
         elif type_node.kind is TypeKind.POINTER:
             type_chain.append('__pointer__')
-            self.get_type_chain(type_node.get_pointee(), type_chain)
+            self._build_type_chain(type_node.get_pointee(), type_chain,
+                                   collection_entries)
         # An array is another possibility.
         elif type_node.kind is TypeKind.CONSTANTARRAY:
             array_size = type_node.get_array_size()
             type_chain.append(('__array__', array_size))
-            self.get_type_chain(type_node.get_array_element_type(), type_chain)
+            self._build_type_chain(type_node.get_array_element_type(),
+                                   type_chain, collection_entries)
         # If it is a typedef lookup, get the original type and return. The
         # chains stops here and the type should be defined by another typedef
         # somewhere.
-        elif type_node.kind is TypeKind.TYPEDEF:
-            self._add_type_to_collection(type_node)
-            type_chain.append(type_node.get_declaration().displayname)
         else:
-            self._add_type_to_collection(type_node)
+            entry = self._add_type_to_collection(type_node)
+            if entry is not None:
+                collection_entries.append(entry)
             type_chain.append(type_node.get_declaration().displayname)
-        return type_chain
 
     @staticmethod
     def assemble_type_string(type_chain, type_string=''):
@@ -150,31 +241,15 @@ class Node(object):
         >>> print Node.assemble_type_string(type_chain, type_string='cmplxIntType')
         other_int (*cmplxIntType[10])[5]
         """
-        # Create a copy because it will be altered.
-        type_chain = type_chain[:]
-        previous_type = None
-        while type_chain:
-            # Pop the first item.
-            item = type_chain.pop(0)
-            # Array.
-            if isinstance(item, tuple) and item[0] == '__array__':
-                # Set brackets if necessary.
-                if previous_type == '__pointer__':
-                    type_string = '(%s)' % type_string
-                type_string += '[%i]' % item[1]
-            # Pointer.
-            elif item == '__pointer__':
-                type_string = '*' + type_string
-            elif isinstance(item, basestring):
-                type_string = '%s %s' % (item, type_string)
-            else:
-                from IPython.core.debugger import Tracer; Tracer()()
-            previous_type = item
-        return type_string
+        try:
+            return assemble_type_string(type_chain, type_string)
+        except ValueError as error:
+            raise clangParserGenericError(str(error))
 
-    def get_pretty_typekind_string(self, type_node, type_string='',
-                                   force_final_type_to=False):
+    def get_final_type_chain(self, type_node, force_final_type_to=False):
         """
+        Returns the type chain of type_node as a tuple.
+
         If force_final_type_to is a string, the final type, e.g. the last item in
         the type chain will be replaced with it. This enables to pass typedef'ed
         types, e.g force_final_type_to='new_int' will transform
@@ -189,6 +264,15 @@ class Node(object):
                chain[-1] != '__pointer__':
                 chain.pop(-1)
             chain.append(force_final_type_to)
+        return tuple(chain)
+
+    def get_pretty_typekind_string(self, type_node, type_string='',
+                                   force_final_type_to=False):
+        """
+        The string representation of the type chain returned by
+        get_final_type_chain().
+        """
+        chain = self.get_final_type_chain(type_node, force_final_type_to)
         ret_str = self.assemble_type_string(chain, type_string)
         return ret_str.strip()
 
@@ -199,7 +283,7 @@ class MacroDefinitionNode(Node):
 
     Will parse all macros. Simple define constants aka
         #define PI 3.14
-    will have self.is_define_constant set to True. More complicated macros will
+    will have self.is_define_constant set to True. Function-like macros will
     have it set to False.
     Only those who have it set to true will be included in the final Cython
     definition file.
@@ -209,38 +293,36 @@ class MacroDefinitionNode(Node):
         if node.kind != CursorKind.MACRO_DEFINITION:
             msg = 'Not a valid macro definition node.'
             raise clangParserWrongNodeKindError(msg)
+        # Macros are always parsed right away. It is cheap and needed to
+        # decide whether or not they are included at all.
+        kwargs['lazy'] = False
         Node.__init__(self, node, *args, **kwargs)
 
     def _parse_node(self):
         # A macro is special and the spelling is just None, therefore use the
         # displayname as the node name.
         self.node_name = self.node.displayname
-        # Of course also append to the list of already used names.
-        self.used_names.append(self.node_name)
-        # Figure out if it is a simple macro definition or not.
-        # XXX: Is there a way to do this within clang?
-        with open(self.node.location.file.name, 'r') as file_object:
-            start = self.node.extent.begin_int_data
-            end = self.node.extent.end_int_data
-            # Minus 2 because
-            # a) Column starts counting at 1, e.g. to read the first column you
-            # would have to seek(0).
-            # b) ???? XXX: I have no idea but it seems to work in all tested
-            #    cases.
-            file_object.seek(start - 2, 0)
-            self.defintion_code = file_object.read(end - start)
-        # XXX: Whacky.
+        # Of course also add it to the already used names.
+        self.used_names.add(self.node_name)
         # As only simple macro definitions are supported and of interest for
         # Cython (there might be rare use for full macros in Cython but the
         # user would also need to specify the types and therefore would need to
-        # add the definition by hand anyway) full macros are not supported. As
-        # soon as a macro definition contains brackets it will be considered to
-        # not be a simple macro definition.
-        if '(' in self.defintion_code or ')' in self.defintion_code:
+        # add the definition by hand anyway) function-like macros are not
+        # supported. A macro is function-like if its name is directly followed
+        # by an opening parenthesis, e.g.
+        #   #define DO(X) X*X
+        # in contrast to the simple definition
+        #   #define SHIFTED (1 << 3)
+        tokens = self.node.get_tokens()
+        name_token = next(tokens, None)
+        first_token = next(tokens, None)
+        if name_token is not None and first_token is not None and \
+           first_token.spelling == '(' and \
+           first_token.extent.start.offset == name_token.extent.end.offset:
             self.is_define_constant = False
         else:
             self.is_define_constant = True
-        self.cython_string = "enum: %s" % self.node_name
+        self.ir = Macro(self.node_name)
 
 
 class TypedefNode(Node):
@@ -292,32 +374,26 @@ class TypedefNode(Node):
             # like 'struct x' or 'union x'. The specifiers are not needed for a
             # typedef in Cython.
             force_final_type = force_final_type.split()[-1]
-        # It can also be a struct/union/enum. If it is, loop through the list of all
-        # nodes, finds the correct one and get the name.
+        # It can also be a struct/union/enum. If it is, get the name of the
+        # node already created for it.
         elif children and (children[0].kind == CursorKind.STRUCT_DECL or \
                           children[0].kind == CursorKind.UNION_DECL or \
                           children[0].kind == CursorKind.ENUM_DECL):
-            all_nodes = self.file_parser.all_parsed_nodes
-            for node in all_nodes:
-                if bool(node.node == children[0]):
-                    force_final_type = node.node_name
-                    break
+            node = self.file_parser.get_registered_node(children[0])
+            if node is not None:
+                force_final_type = node.node_name
+                self.file_parser.add_dependency(node.node_name)
 
-        # Get a pretty string representation of the original type.
-        self.pretty_original_type = \
-            self.get_pretty_typekind_string(self.original_type, self.node_name,
-                                       force_final_type)
-
-        # Assemble the Cython string. The syntax is almost the same as in C.
-        self.cython_string = 'ctypedef %s' % (self.pretty_original_type)
+        # The syntax of the Cython string is almost the same as in C.
+        self.ir = Typedef(self.node_name, type=self.get_final_type_chain(
+            self.original_type, force_final_type))
 
     def _parse_function_pointer(self):
         """
         Parse function pointers seperatly in an attempt to keep the code clean.
         """
         function_pointer_node = FunctionPointerNode(self.node, self.file_parser)
-        self.cython_string = 'ctypedef %s' % \
-            function_pointer_node.get_cython_string()
+        self.ir = Typedef(self.node_name, type=function_pointer_node.get_ir())
         return
 
 
@@ -345,32 +421,25 @@ class FunctionPointerNode(Node):
 
     def _parse_node(self):
         # Get the return type and the function name.
-        return_type = self.get_pretty_typekind_string(
+        return_chain = self.get_final_type_chain(
             self.canonical.get_pointee().get_result())
-        if return_type.strip() == '':
+        if self.assemble_type_string(return_chain).strip() == '':
             # If the return type is none, it refers to a typedef of a
             # previously unnamed struct/union/enum. Find that typedef.
             declaration = self.node.type.get_declaration()
             for child in declaration.get_children():
                 if child.kind == CursorKind.TYPE_REF:
-                    return_type = child.displayname
+                    return_chain = (child.displayname,)
+                    self.file_parser.add_dependency(child.displayname)
 
-        function_name = self.node_name
         # The children are the parameters.
         params = []
         for child in self.node.get_children():
             if child.kind != CursorKind.PARM_DECL:
                 continue
-            # Fix some pure formatting issues with spaces between pointer
-            # declarations and some other minor issues.
-            pretty_type_string = \
-                self.get_pretty_typekind_string(child.type).replace(' *', '*')
-            params.append('%s %s' % (pretty_type_string, child.spelling))
-            # Fix some formatting issues with unnamed function parameters which
-            # would result in a whitespace at the end.
-            params[-1] = params[-1].strip()
-        self.cython_string = '%s (*%s)(%s)' % (return_type, function_name,
-                                               ', '.join(params))
+            params.append(Param(child.spelling,
+                                self.get_final_type_chain(child.type)))
+        self.ir = FunctionPointer(self.node_name, return_chain, tuple(params))
 
 
 class StructOrUnionNode(Node):
@@ -402,38 +471,33 @@ class StructOrUnionNode(Node):
                 for _i in child.get_children():
                     grandchilds.append(_i)
                 if not grandchilds:
-                    node = UnionNode(child, self.file_parser)
-                    self.file_parser.all_parsed_nodes.append(node)
+                    self._add_nested_node(child, UnionNode)
                     continue
             if child.kind == CursorKind.STRUCT_DECL:
                 grandchilds = []
                 for _i in child.get_children():
                     grandchilds.append(_i)
                 if not grandchilds:
-                    node = StructNode(child, self.file_parser)
-                    self.file_parser.all_parsed_nodes.append(node)
+                    self._add_nested_node(child, StructNode)
                     continue
             # Only get field declarations.
             if child.kind != CursorKind.FIELD_DECL:
                 continue
             self.fields.append(child)
 
-        # Loop over all fields and get a pretty string representation.
-        pretty_fields = []
+        # Loop over all fields and get their intermediate representation.
+        fields = []
         for field in self.fields:
             if field.kind != CursorKind.FIELD_DECL:
                 continue
-            if field.type.get_declaration().kind == CursorKind.UNION_DECL:
-                node = UnionNode(field.type.get_declaration(), self.file_parser)
-                self.file_parser.all_parsed_nodes.append(node)
-                pretty_fields.append('%s%s %s' % (TAB, node.node_name,
-                                                  field.displayname))
+            declaration = field.type.get_declaration()
+            if declaration.kind == CursorKind.UNION_DECL:
+                node = self._add_nested_node(declaration, UnionNode)
+                fields.append(Field(field.displayname, (node.node_name,)))
                 continue
-            if field.type.get_declaration().kind == CursorKind.STRUCT_DECL:
-                node = StructNode(field.type.get_declaration(), self.file_parser)
-                self.file_parser.all_parsed_nodes.append(node)
-                pretty_fields.append('%s%s %s' % (TAB, node.node_name,
-                                                  field.displayname))
+            if declaration.kind == CursorKind.STRUCT_DECL:
+                node = self._add_nested_node(declaration, StructNode)
+                fields.append(Field(field.displayname, (node.node_name,)))
                 continue
             # Check if its a function pointer.
             canonical = field.type.get_canonical()
@@ -441,15 +505,24 @@ class StructOrUnionNode(Node):
                (canonical.get_pointee().kind == TypeKind.FUNCTIONPROTO or \
                 canonical.get_pointee().kind == TypeKind.FUNCTIONNOPROTO):
                 function_pointer_node = FunctionPointerNode(field, self.file_parser)
-                pretty_type = function_pointer_node.get_cython_string()
+                fields.append(function_pointer_node.get_ir())
             else:
-                pretty_type = self.get_pretty_typekind_string(field.type,
-                                                         field.displayname)
-            pretty_fields.append('%s%s' % (TAB, pretty_type))
-        if len(pretty_fields) == 0:
-            pretty_fields.append('%spass' % TAB)
-        self.cython_string = 'cdef %s %s:\n' % (self.node_specifier, self.node_name)
-        self.cython_string += '\n'.join(pretty_fields)
+                fields.append(Field(field.displayname,
+                                    self.get_final_type_chain(field.type)))
+        self.ir = StructOrUnion(self.node_name, specifier=self.node_specifier,
+                                fields=tuple(fields))
+
+    def _add_nested_node(self, cursor, node_class):
+        """
+        Returns the node for a nested struct or union. It will only be created
+        and added to self.nested_nodes once, no matter how often it is used.
+        """
+        node, created = self.file_parser.get_or_create_node(cursor, node_class)
+        if created:
+            self.nested_nodes.append(node)
+        else:
+            self.file_parser.add_dependency(node.node_name)
+        return node
 
 
 class StructNode(StructOrUnionNode):
@@ -481,10 +554,8 @@ class EnumNode(Node):
             # never should be anything else in here if the C code is valid.
             if child.kind == CursorKind.ENUM_CONSTANT_DECL:
                 self.fields.append(child)
-        self.cython_string = 'cdef enum %s:\n' % self.node_name
-        # Append all members, if no members exist, append pass.
-        self.cython_string += '\n'.join(['%s%s' % \
-            (TAB, _i.displayname) for _i in self.fields])
+        self.ir = Enum(self.node_name, constants=tuple(
+            _i.displayname for _i in self.fields))
 
 
 class FunctionProtoNode(Node):
@@ -507,14 +578,10 @@ class FunctionProtoNode(Node):
         self._add_type_to_collection(self.return_type)
 
         # XXX: What happens if a struct/union/enum is returned?
-        self.pretty_return_string = \
-            self.get_pretty_typekind_string(self.return_type)
-        # XXX: Hacky
-        self.pretty_return_string = self.pretty_return_string.replace(' ', '')
+        return_chain = self.get_final_type_chain(self.return_type)
 
         # Loop through the node's children to get all function parameters.
-        self.pretty_parameter_names = []
-        self.function_parameters = []
+        params = []
         for param in self.node.get_children():
             # Filter to only get the parameters.
             if param.kind != CursorKind.PARM_DECL:
@@ -527,32 +594,26 @@ class FunctionProtoNode(Node):
                param.kind == CursorKind.ENUM_DECL:
                 continue
             else:
-                p_type = self.get_pretty_typekind_string(param.type)
+                p_chain = self.get_final_type_chain(param.type)
             # Check if its a function pointer.
             canonical = param.type.get_canonical()
             if canonical.kind == TypeKind.POINTER and \
                (canonical.get_pointee().kind == TypeKind.FUNCTIONPROTO or \
                 canonical.get_pointee().kind == TypeKind.FUNCTIONNOPROTO):
                 function_pointer_node = FunctionPointerNode(param, self.file_parser)
-                self.pretty_parameter_names.append(function_pointer_node.get_cython_string())
+                params.append(function_pointer_node.get_ir())
                 continue
 
             # Handle compiler specific datatype va_list.
             # XXX: Only tested with gcc and it will likely not correctly work
             # with other compilers.
-            if p_type == '__va_list_tag *':
-                p_type = 'va_list'
+            if self.assemble_type_string(p_chain).strip() == '__va_list_tag *':
+                p_chain = ('va_list',)
                 self.file_parser.is_va_list_used = True
 
-            self.pretty_parameter_names.append('%s %s' % (p_type,
-                                               param.displayname))
-            # Some formatting issues. Does not really change anything else.
-            # Maybe find a more concise way of doing this.
-            self.pretty_parameter_names[-1] = \
-                self.pretty_parameter_names[-1].replace(' * ', ' *')
-        # Assemble the cython string.
-        self.cython_string = '%s %s(%s)' % (self.pretty_return_string, self.node_name,
-            ', '.join(self.pretty_parameter_names))
+            params.append(Param(param.displayname, p_chain))
+        self.ir = Function(self.node_name, return_chain=return_chain,
+                           params=tuple(params))
 
 
 if __name__ == "__main__":
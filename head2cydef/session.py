@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parse many headers with shared libclang state.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from clang.cindex import Index
+
+from cache import TranslationUnitCache
+from head2cydef import CFileParser
+
+
+class ParserSession(object):
+    """
+    Creates CFileParser instances for many headers that share one libclang
+    Index, the compiler arguments, the translation unit cache and the include
+    directives read from system headers.
+
+    >>> session = ParserSession(args=['-DSOME_MACRO'])
+    >>> parser = session.from_string('int f(int a);', 'a.h')
+    >>> parser.index is session.index
+    True
+
+    The type chain cache stays with every single parser. Its entries refer to
+    the cursors of one translation unit and anonymous types are named by
+    their position in it, so they cannot be reused for another header.
+    """
+    def __init__(self, args=None, cache_dir=None, profile='default',
+                 macros=True, **kwargs):
+        """
+        :param args: Additional command line arguments passed to clang for
+            every header.
+        :param cache_dir: If given, parsed translation units are stored in and
+            loaded from this directory.
+        :param profile: The libclang parse profile of all headers.
+        :param macros: Whether or not #define constants are converted.
+
+        All further keyword arguments are passed to every CFileParser.
+        """
+        self.index = Index.create()
+        self.args = list(args or [])
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = TranslationUnitCache(cache_dir)
+        self.parser_kwargs = kwargs
+        self.parser_kwargs.update(profile=profile, macros=macros)
+        # Include directives of files that are not part of any library, by
+        # filename. See CFileParser._get_include_lines().
+        self.include_lines = {}
+
+    def _get_parser_kwargs(self, kwargs):
+        parser_kwargs = dict(self.parser_kwargs)
+        parser_kwargs.update(kwargs)
+        parser_kwargs.setdefault('args', self.args)
+        parser_kwargs.setdefault('cache_dir', self.cache)
+        parser_kwargs['index'] = self.index
+        parser_kwargs['session'] = self
+        return parser_kwargs
+
+    def parse(self, filename, **kwargs):
+        """
+        Returns a CFileParser for the given header. Keyword arguments
+        override the ones of the session.
+        """
+        return CFileParser(filename, **self._get_parser_kwargs(kwargs))
+
+    def from_string(self, source, name, extra_files=None, **kwargs):
+        """
+        Returns a CFileParser for a header given as a string. See
+        CFileParser.from_string().
+        """
+        return CFileParser.from_string(source, name, extra_files=extra_files,
+                                       **self._get_parser_kwargs(kwargs))
+
+    def clear(self):
+        """
+        Forget the include directives of all system headers, e.g. after they
+        changed.
+        """
+        self.include_lines.clear()
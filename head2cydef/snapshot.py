@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stores the intermediate representation of a parsed header on disk, so it can
+be rendered again without libclang.
+
+A snapshot is a JSON lines file. The first line describes the header:
+
+    {"format": "head2cydef-snapshot", "version": 1, "name": "some.h",
+     "is_va_list_used": false, "cimports": [...],
+     "include_spellings": [...], "dependencies": [...]}
+
+Every external header is one line
+
+    {"record": "ExternalBlock", "include": "stdint.h", "filename": "..."}
+
+and every declaration one line
+
+    {"block": 0, "record": {"record": "Typedef", "name": "uint8_t", ...}}
+
+where block is the index of the external header the declaration belongs to
+or null for the declarations of the header itself. Records are written as
+objects with their class name as "record", type chains as lists.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import json
+import os
+import tempfile
+
+import ir
+
+
+FORMAT = 'head2cydef-snapshot'
+VERSION = 1
+
+
+class Snapshot(object):
+    """
+    A loaded snapshot. header is the ir.Header and dependencies the include
+    closure of the header at the time it was parsed.
+    """
+    def __init__(self, header, dependencies=None):
+        self.header = header
+        self.dependencies = list(dependencies or [])
+
+    def iter_cython_lines(self):
+        return self.header.iter_cython_lines()
+
+    def render_cython_header(self, filename_or_object, only_if_changed=False):
+        return self.header.render_cython_header(filename_or_object,
+                                                only_if_changed)
+
+
+def _encode(value):
+    if isinstance(value, ir.Record):
+        encoded = {'record': value.__class__.__name__}
+        for field in value._get_fields():
+            encoded[field] = _encode(getattr(value, field))
+        return encoded
+    if isinstance(value, tuple):
+        return [_encode(_i) for _i in value]
+    if isinstance(value, frozenset):
+        return sorted(value)
+    return value
+
+
+def _decode(value):
+    """
+    Inverse of _encode(). All lists are tuples again and all strings byte
+    strings.
+    """
+    if isinstance(value, dict):
+        record_class = getattr(ir, str(value.pop('record')), None)
+        if not isinstance(record_class, type) or \
+           not issubclass(record_class, ir.Record):
+            msg = 'Unknown record type in snapshot.'
+            raise ValueError(msg)
+        kwargs = dict((str(key), _decode(item)) for key, item in
+                      value.iteritems())
+        if 'dependencies' in kwargs:
+            kwargs['dependencies'] = frozenset(kwargs['dependencies'] or [])
+        return record_class(**kwargs)
+    if isinstance(value, list):
+        return tuple(_decode(_i) for _i in value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _iter_lines(header, dependencies):
+    yield {'format': FORMAT, 'version': VERSION, 'name': header.name,
+           'is_va_list_used': header.is_va_list_used,
+           'cimports': _encode(header.cimports or ()),
+           'include_spellings': _encode(header.include_spellings or ()),
+           'dependencies': list(dependencies or [])}
+    for index, block in enumerate(header.external_blocks):
+        yield {'record': 'ExternalBlock', 'include': block.include,
+               'filename': block.filename}
+        for declaration in block.declarations:
+            yield {'block': index, 'record': _encode(declaration)}
+    for declaration in header.declarations:
+        yield {'block': None, 'record': _encode(declaration)}
+
+
+def dump(header, filename, dependencies=None):
+    """
+    Writes an ir.Header to a snapshot file.
+
+    :param dependencies: Optional list of the files the header was parsed
+        from.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as file_object:
+        for line in _iter_lines(header, dependencies):
+            file_object.write(json.dumps(line, sort_keys=True,
+                                         separators=(',', ':')))
+            file_object.write('\n')
+    os.rename(temp_filename, filename)
+
+
+def load(filename):
+    """
+    Reads a snapshot file and returns a Snapshot. Does not need libclang.
+
+    >>> import os, tempfile
+    >>> header = ir.Header('some.h', (), False, (ir.Macro('SOME_CONSTANT'),))
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'some.snapshot')
+    >>> dump(header, filename)
+    >>> snapshot = load(filename)
+    >>> snapshot.header == header
+    True
+    >>> for line in snapshot.iter_cython_lines():
+    ...     print line,
+    cdef extern from "some.h" nogil:
+        enum: SOME_CONSTANT
+    """
+    with open(filename, 'r') as file_object:
+        lines = iter(file_object)
+        try:
+            info = json.loads(next(lines))
+        except (StopIteration, ValueError):
+            msg = '%s is not a snapshot.' % filename
+            raise ValueError(msg)
+        if info.get('format') != FORMAT:
+            msg = '%s is not a snapshot.' % filename
+            raise ValueError(msg)
+        if info.get('version') != VERSION:
+            msg = 'Unsupported snapshot version %s.' % info.get('version')
+            raise ValueError(msg)
+        blocks = []
+        declarations = []
+        for line in lines:
+            line = json.loads(line)
+            if line.get('record') == 'ExternalBlock':
+                blocks.append((_decode(line['include']),
+                               _decode(line['filename']), []))
+                continue
+            declaration = _decode(line['record'])
+            if line['block'] is None:
+                declarations.append(declaration)
+            else:
+                blocks[line['block']][2].append(declaration)
+    external_blocks = tuple(ir.ExternalBlock(include, tuple(block_decls),
+                                             block_filename)
+                            for include, block_filename, block_decls in blocks)
+    header = ir.Header(_decode(info['name']), external_blocks,
+                       info['is_va_list_used'], tuple(declarations),
+                       _decode(info.get('cimports', [])) or None,
+                       _decode(info.get('include_spellings', [])) or None)
+    return Snapshot(header, [_decode(_i) for _i in info['dependencies']])
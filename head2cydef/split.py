@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Split a parsed header into one Cython definition file per source header.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from collections import OrderedDict
+import keyword
+import os
+import re
+
+from ir import Cimport, Function, Header, Param
+
+
+def get_module_name(filename):
+    """
+    The name of the Cython module for a header or .pxd file. Characters not
+    allowed in identifiers are replaced by underscores.
+
+    >>> print get_module_name('/usr/include/SDL/SDL_video.h')
+    SDL_video
+    >>> print get_module_name('/usr/include/foo-bar.1.h')
+    foo_bar_1
+    >>> print get_module_name('/usr/include/3d.h')
+    _3d
+    """
+    name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(filename))[0])
+    if not name or name[0].isdigit() or keyword.iskeyword(name):
+        name = '_' + name
+    return name
+
+
+def _uses_va_list(declaration):
+    if not isinstance(declaration, Function):
+        return False
+    for param in declaration.params:
+        if isinstance(param, Param) and param.chain == ('va_list',):
+            return True
+    return False
+
+
+def split_header(header, root_module=None, package=None, root_filename=None):
+    """
+    Splits an ir.Header into one ir.Header for every file its declarations
+    are in. Returns an OrderedDict mapping the module names to the headers.
+    The module of the parsed header itself always comes first.
+
+    Every header only contains the external types and the va_list definition
+    it uses itself. Types declared in another of the files are cimported
+    from that file's module.
+
+    :param root_module: The module name of the parsed header. Defaults to
+        its filename without the extension.
+    :param package: If given, the cimports are absolute imports from this
+        package, e.g. 'from package.module cimport name'.
+    :param root_filename: The absolute filename of the parsed header. If not
+        given, only declarations without a filename belong to it.
+
+    The files are included with their spelling in header.include_spellings
+    or their basename if it is not known.
+
+    Raises a ValueError if two files would end up in the same module.
+
+    >>> from ir import Macro, StructOrUnion, Field
+    >>> header = Header('main.h', (), False, (
+    ...     StructOrUnion('point', '/inc/sys/types.h', specifier='struct',
+    ...                   fields=(Field('x', ('int',)),)),
+    ...     Function('draw', '/inc/main.h', frozenset(['point']),
+    ...              return_chain=('void',),
+    ...              params=(Param('p', ('__pointer__', 'point')),))),
+    ...     include_spellings=(('/inc/sys/types.h', 'sys/types.h'),))
+    >>> headers = split_header(header, root_filename='/inc/main.h')
+    >>> for module, module_header in headers.iteritems():
+    ...     print '# %s.pxd' % module
+    ...     for line in module_header.iter_cython_lines():
+    ...         print line,
+    # main.pxd
+    from types cimport point
+    <BLANKLINE>
+    cdef extern from "main.h" nogil:
+        void draw(point *p)
+    # types.pxd
+    cdef extern from "sys/types.h" nogil:
+        cdef struct point:
+            int x
+    """
+    if root_module is None:
+        root_module = get_module_name(header.name)
+    include_spellings = dict(header.include_spellings or ())
+    # Group the declarations by file and remember where every name is
+    # declared.
+    groups = OrderedDict([(root_module, (root_filename, header.name, []))])
+    modules = {root_filename: root_module}
+    declared_in = {}
+    for declaration in header.declarations:
+        filename = declaration.filename
+        if filename is not None:
+            filename = os.path.abspath(filename)
+        if filename is None or filename == root_filename:
+            module = root_module
+        elif filename in modules:
+            module = modules[filename]
+        else:
+            module = get_module_name(filename)
+            if module in groups:
+                msg = '%s and %s would both be written to the module %s.' % (
+                    groups[module][0] or header.name, filename, module)
+                raise ValueError(msg)
+            groups[module] = (filename, include_spellings.get(
+                filename, os.path.basename(filename)), [])
+            modules[filename] = module
+        groups[module][2].append(declaration)
+        declared_in.setdefault(declaration.name, module)
+
+    headers = OrderedDict()
+    for module, (_, include, declarations) in groups.iteritems():
+        needed = set()
+        for declaration in declarations:
+            needed.update(declaration.dependencies)
+        cimports = {}
+        for name in needed:
+            other_module = declared_in.get(name)
+            if other_module is None or other_module == module:
+                continue
+            cimports.setdefault(other_module, []).append(name)
+        if package:
+            prefix = package + '.'
+        else:
+            prefix = ''
+        external_blocks = tuple(block for block in header.external_blocks if
+            any(_i.name in needed for _i in block.declarations))
+        headers[module] = Header(include, external_blocks,
+            any(_uses_va_list(_i) for _i in declarations),
+            tuple(declarations),
+            tuple(Cimport(prefix + _i, tuple(sorted(cimports[_i]))) for _i in
+                  sorted(cimports)) or None)
+    return headers
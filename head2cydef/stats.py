@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Timings and counters collected while converting a header.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import time
+
+
+class ParserStats(object):
+    """
+    Wall time spent in each phase of a conversion and some counters.
+
+    The phases are
+        parse
+            Parsing the header with libclang or loading it from the cache.
+        sort
+            Sorting the top level cursors and creating the top level nodes.
+            Only #define constants are parsed right away.
+        resolve
+            Parsing the nodes and collecting the types they use.
+        external_types
+            Sorting the used types that are defined in other headers.
+        render
+            Assembling the output lines.
+
+    Phases that run more than once, e.g. rendering twice, are summed up.
+    """
+    PHASES = ['parse', 'sort', 'resolve', 'external_types', 'render']
+
+    def __init__(self):
+        self.timings = OrderedDict((_i, 0.0) for _i in self.PHASES)
+        # Number of created nodes per Node subclass.
+        self.node_counts = {}
+        self.includes = 0
+        self.external_types = 0
+        self.output_lines = 0
+
+    @contextmanager
+    def timer(self, phase):
+        """
+        Adds the wall time spent in the with block to the given phase.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.time() - start)
+
+    def add_time(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def count_node(self, node):
+        name = node.__class__.__name__
+        self.node_counts[name] = self.node_counts.get(name, 0) + 1
+
+    def to_dict(self):
+        return {
+            'timings': dict(self.timings),
+            'total_time': sum(self.timings.itervalues()),
+            'node_counts': dict(self.node_counts),
+            'nodes': sum(self.node_counts.itervalues()),
+            'includes': self.includes,
+            'external_types': self.external_types,
+            'output_lines': self.output_lines}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), sort_keys=True, **kwargs)
+
+    def __str__(self):
+        return format_stats(self.to_dict())
+
+
+def format_stats(stats):
+    """
+    Human readable representation of the dictionary returned by
+    ParserStats.to_dict().
+
+    >>> stats = ParserStats()
+    >>> stats.output_lines = 12
+    >>> print format_stats(stats.to_dict())  # doctest: +NORMALIZE_WHITESPACE
+    parse           0.000 s
+    sort            0.000 s
+    resolve         0.000 s
+    external_types  0.000 s
+    render          0.000 s
+    total           0.000 s
+    nodes           0
+    includes        0
+    external types  0
+    output lines    12
+    """
+    lines = []
+    timings = stats['timings']
+    for phase in ParserStats.PHASES + sorted(set(timings) -
+                                             set(ParserStats.PHASES)):
+        lines.append('%-22s %.3f s' % (phase, timings.get(phase, 0.0)))
+    lines.append('%-22s %.3f s' % ('total', stats['total_time']))
+    lines.append('%-22s %i' % ('nodes', stats['nodes']))
+    for name, count in sorted(stats['node_counts'].iteritems()):
+        lines.append('  %-20s %i' % (name, count))
+    lines.append('%-22s %i' % ('includes', stats['includes']))
+    lines.append('%-22s %i' % ('external types', stats['external_types']))
+    lines.append('%-22s %i' % ('output lines', stats['output_lines']))
+    return '\n'.join(lines)
@@ -2,18 +2,50 @@ from colorama import init, Fore, Back, Style
 import difflib
 import doctest
 import inspect
+import json
 import os
+import pickle
 import re
+import shutil
+import socket
 from StringIO import StringIO
 import tempfile
+import threading
 import unittest
 
 from head2cydef import CFileParser
-from head2cydef import nodes
+from head2cydef import daemon, head2cydef, ir, nodes, snapshot, split, stats
+from head2cydef.batch import convert_many
+from head2cydef.session import ParserSession
+from head2cydef.watch import Watcher
 from testing_constructs import testing_pairs
 
 init()
 
+# All testing constructs are parsed from memory within one session.
+SESSION = ParserSession()
+CONSTRUCT_DIRECTORY = os.path.join(tempfile.gettempdir(),
+                                   'head2cydef_testing_constructs')
+
+
+def get_construct_filename(key, basename=False):
+    filename = '%s.h' % key
+    if basename:
+        return filename
+    return os.path.join(CONSTRUCT_DIRECTORY, filename)
+
+
+def parse_construct(key):
+    """
+    Converts the C code of one of the testing constructs. Returns the C code,
+    the expected and the actual Cython code.
+    """
+    c_code, cython_code = testing_pairs[key]
+    parser = SESSION.from_string(c_code, get_construct_filename(key))
+    output_object = StringIO()
+    parser.render_cython_header(output_object)
+    return c_code, cython_code, output_object.getvalue().strip()
+
 
 class HeaderToCythonTestCase(unittest.TestCase):
     def setUp(self):
@@ -35,84 +67,895 @@ class HeaderToCythonTestCase(unittest.TestCase):
         with open(self.temp_file, 'w') as file_object:
             file_object.write(string)
 
-    def test_testingConstructs(self):
-        print '%i code pairs tested' % len(testing_pairs.keys())
-        for key, value in testing_pairs.iteritems():
-            c_code = value[0]
-            cython_code = value[1]
-            self.writeToTempFile(c_code)
-            # Parse the file.
-            parser = CFileParser(self.temp_file)
+    def assertConstructOutput(self, key, c_code, cython_code, output):
+        """
+        Compares the output for one of the testing constructs with the
+        expected Cython code.
+        """
+        # The filename is represented by [[[FILENAME]]] in the testing
+        # constructs. Replace it with the real filename.
+        cython_code = cython_code.replace('[[[FILENAME]]]',
+                          '"%s"' % get_construct_filename(key, basename=True))
+
+        # Anonymous structs/unions/enums get generated names. These will have
+        # the names
+        #   Struct_anonymous_[[ID]]
+        #   Union_anonymous_[[ID]]
+        #   Enum_anonymous_[[ID]]
+        # in the reference Cython output. These will need to be replaced.
+        struct_replacements = \
+                re.findall(r"Struct_anonymous_[0-9a-f]{6}", output)
+        union_replacements = \
+                re.findall(r"Union_anonymous_[0-9a-f]{6}", output)
+        enum_replacements = \
+                re.findall(r"Enum_anonymous_[0-9a-f]{6}", output)
+        if struct_replacements:
+            cython_code = cython_code.replace(
+                "Struct_anonymous_[[ID]]", struct_replacements[0])
+        if union_replacements:
+            cython_code = cython_code.replace(
+                "Union_anonymous_[[ID]]", union_replacements[0])
+        if enum_replacements:
+            cython_code = cython_code.replace(
+                "Enum_anonymous_[[ID]]", enum_replacements[0])
+
+        # Use a custom assert method to print a meaningful and verbose
+        # error message to facilitate debugging. Make it colorful because
+        # it is needed quite a lot during development and just makes things
+        # easier to spot.
+        try:
+            assert(output == cython_code)
+        except AssertionError:
+            d = difflib.Differ()
+            diff = d.compare(output.splitlines(), cython_code.splitlines())
+            diff = list(diff)
+
+            print Fore.BLUE
+            print '=' * 80
+            print '=' * 80, Fore.RESET
+            print 'Error in test construct:', Fore.GREEN, key, Fore.BLUE
+            print '_' * 80, Fore.YELLOW
+            print 'C code:', Fore.RESET
+            print c_code, Fore.BLUE
+            print '_' * 80, Fore.YELLOW
+            print 'Expected cython code:', Fore.RESET
+            print cython_code, Fore.BLUE
+            print '_' * 80, Fore.YELLOW
+            print 'Received cython code (- needs to go, + to get there):',\
+                Fore.RESET
+
+            for line in diff:
+                if line.startswith('  '):
+                    print Back.GREEN, Fore.WHITE, line[2:], Style.RESET_ALL
+                elif line.startswith('+ ') or \
+                     line.startswith('- '):
+                    print Back.RED, Fore.WHITE, line, Style.RESET_ALL
+            print Fore.RESET, Back.RESET
+
+            print Fore.BLUE
+            print '=' * 80, Fore.BLUE
+            print '=' * 80, Fore.RESET
+            self.fail('Wrong output for test construct %s.' % key)
+
+    def test_convertMany(self):
+        """
+        Converts multiple headers in parallel and reports failures per header.
+        """
+        temp_dir = tempfile.mkdtemp()
+        headers = [os.path.join(temp_dir, 'header_%i.h' % _i)
+                   for _i in xrange(3)]
+        for _i, header in enumerate(headers):
+            with open(header, 'w') as file_object:
+                file_object.write('int func_%i(float a);\n' % _i)
+        # The last one does not exist.
+        headers.append(os.path.join(temp_dir, 'missing.h'))
+        outputs = [os.path.splitext(_i)[0] + '.pxd' for _i in headers]
+        results = convert_many(headers, outputs, jobs=2)
+        self.assertEqual([_i.header for _i in results], headers)
+        self.assertEqual([_i.success for _i in results],
+                         [True, True, True, False])
+        self.assertTrue(results[-1].error)
+        for _i in xrange(3):
+            with open(outputs[_i], 'r') as file_object:
+                self.assertTrue('int func_%i(float a)' % _i in
+                                file_object.read())
+            os.remove(outputs[_i])
+            os.remove(headers[_i])
+        os.rmdir(temp_dir)
+
+    def test_convertManyFreshSession(self):
+        """
+        Include directives of system headers are not reused from a previous
+        call as they might have changed in between.
+        """
+        temp_dir = tempfile.mkdtemp()
+        try:
+            include_directory = os.path.join(temp_dir, 'include')
+            os.mkdir(include_directory)
+            for name, contents in (('types_a.h', 'typedef int ext_t;\n'),
+                                   ('types_b.h', 'typedef long ext_t;\n'),
+                                   ('ext.h', '#include "types_a.h"\n')):
+                with open(os.path.join(include_directory, name), 'w') as \
+                        file_object:
+                    file_object.write(contents)
+            header = os.path.join(temp_dir, 'a.h')
+            output = os.path.join(temp_dir, 'a.pxd')
+            with open(header, 'w') as file_object:
+                file_object.write('#include <ext.h>\next_t f(void);\n')
+            args = ['-I%s' % include_directory]
+            results = convert_many([header], [output], jobs=1, args=args)
+            self.assertTrue(results[0].success)
+            with open(output, 'r') as file_object:
+                self.assertTrue('cdef extern from "types_a.h" nogil:\n'
+                                '    ctypedef int ext_t' in
+                                file_object.read())
+            # Include another file in the same line of the system header.
+            with open(os.path.join(include_directory, 'ext.h'), 'w') as \
+                    file_object:
+                file_object.write('#include "types_b.h"\n')
+            results = convert_many([header], [output], jobs=1, args=args)
+            self.assertTrue(results[0].success)
+            with open(output, 'r') as file_object:
+                self.assertTrue('cdef extern from "types_b.h" nogil:\n'
+                                '    ctypedef long ext_t' in
+                                file_object.read())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_translationUnitCache(self):
+        """
+        A cached translation unit is reused until the header changes.
+        """
+        cache_dir = tempfile.mkdtemp()
+        self.writeToTempFile('#define SOME_CONSTANT 1\nint func(float a);')
+        outputs = []
+        for _i in xrange(2):
+            parser = CFileParser(self.temp_file, cache_dir=cache_dir)
             output_object = StringIO()
             parser.render_cython_header(output_object)
-            output_object.seek(0, 0)
-            output = output_object.read().strip()
-
-            # The filename is represented by [[[FILENAME]]] in the testing
-            # constructs. Replace it with the real filename.
-            cython_code = cython_code.replace('[[[FILENAME]]]',
-                              '"%s"' % os.path.basename(self.temp_file))
-
-            # Randomly created struct/unions/enums names are possible. These
-            # will have the names
-            #   Struct_temp_random_[[RANDOMINT]]
-            #   Union_temp_random_[[RANDOMINT]]
-            #   Enum_temp_random_[[RANDOMINT]]
-            # in the reference Cython output. These will need to be replaced.
-            struct_replacements = \
-                    re.findall(r"Struct_temp_random_[0-9]{6}", output)
-            union_replacements = \
-                    re.findall(r"Union_temp_random_[0-9]{6}", output)
-            enum_replacements = \
-                    re.findall(r"Enum_temp_random_[0-9]{6}", output)
-            if struct_replacements:
-            #   Struct_temp_random_[[RANDOMINT]]
-                cython_code = cython_code.replace(
-                    "Struct_temp_random_[[RANDOMINT]]", struct_replacements[0])
-            if union_replacements:
-                cython_code = cython_code.replace(
-                    "Union_temp_random_[[RANDOMINT]]", union_replacements[0])
-            if enum_replacements:
-                cython_code = cython_code.replace(
-                    "Enum_temp_random_[[RANDOMINT]]", enum_replacements[0])
-
-            # Use a custom assert method to print a meaningful and verbose
-            # error message to facilitate debugging. Make it colorful because
-            # it is needed quite a lot during development and just makes things
-            # easier to spot.
+            outputs.append(output_object.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertTrue('enum: SOME_CONSTANT' in outputs[0])
+        ast_files = [_i for _i in os.listdir(cache_dir) if _i.endswith('.ast')]
+        self.assertEqual(len(ast_files), 1)
+        # Changing the header invalidates the cached file.
+        self.writeToTempFile('int other_func(float a);')
+        parser = CFileParser(self.temp_file, cache_dir=cache_dir)
+        output_object = StringIO()
+        parser.render_cython_header(output_object)
+        self.assertTrue('int other_func(float a)' in output_object.getvalue())
+        self.assertNotEqual(ast_files, [_i for _i in os.listdir(cache_dir)
+                                        if _i.endswith('.ast')])
+        shutil.rmtree(cache_dir)
+
+    def test_translationUnitCacheRelativeArguments(self):
+        """
+        Relative include directories resolve differently in another working
+        directory and must not reuse the cached translation unit.
+        """
+        temp_dir = tempfile.mkdtemp()
+        current_directory = os.getcwd()
+        try:
+            header = os.path.join(temp_dir, 'header.h')
+            with open(header, 'w') as file_object:
+                file_object.write('#include <ext.h>\next_t func(void);\n')
+            outputs = []
+            for name, type_name in (('a', 'int'), ('b', 'long')):
+                os.makedirs(os.path.join(temp_dir, name, 'include'))
+                with open(os.path.join(temp_dir, name, 'include', 'ext.h'),
+                          'w') as file_object:
+                    file_object.write('typedef %s ext_t;\n' % type_name)
+                os.chdir(os.path.join(temp_dir, name))
+                parser = CFileParser(header, args=['-Iinclude'],
+                    cache_dir=os.path.join(temp_dir, 'cache'))
+                outputs.append(''.join(parser.iter_cython_lines()))
+            self.assertTrue('ctypedef int ext_t' in outputs[0])
+            self.assertTrue('ctypedef long ext_t' in outputs[1])
+        finally:
+            os.chdir(current_directory)
+            shutil.rmtree(temp_dir)
+
+    def test_incrementalConversion(self):
+        """
+        Only outputs whose include closure changed are regenerated.
+        """
+        temp_dir = tempfile.mkdtemp()
+        manifest = os.path.join(temp_dir, 'manifest.json')
+        included = os.path.join(temp_dir, 'included.h')
+        headers = [os.path.join(temp_dir, 'header_%i.h' % _i)
+                   for _i in xrange(2)]
+        with open(included, 'w') as file_object:
+            file_object.write('typedef int newInt;\n')
+        with open(headers[0], 'w') as file_object:
+            file_object.write('#include "included.h"\nnewInt func(int a);\n')
+        with open(headers[1], 'w') as file_object:
+            file_object.write('int other_func(int a);\n')
+
+        results = convert_many(headers, jobs=1, manifest=manifest)
+        self.assertEqual([_i.skipped for _i in results], [False, False])
+        results = convert_many(headers, jobs=1, manifest=manifest)
+        self.assertEqual([_i.skipped for _i in results], [True, True])
+        # Changing the included file only triggers the first header.
+        with open(included, 'w') as file_object:
+            file_object.write('typedef long newInt;\n')
+        os.utime(included, (0, 0))
+        results = convert_many(headers, jobs=1, manifest=manifest)
+        self.assertEqual([_i.skipped for _i in results], [False, True])
+
+        # All files written with split are recorded and checked.
+        results = convert_many(headers[:1], jobs=1, manifest=manifest,
+                               split=True)
+        sibling = os.path.join(temp_dir, 'included.pxd')
+        self.assertEqual(results[0].generated,
+                         [os.path.join(temp_dir, 'header_0.pxd'), sibling])
+        results = convert_many(headers[:1], jobs=1, manifest=manifest,
+                               split=True)
+        self.assertTrue(results[0].skipped)
+        os.remove(sibling)
+        results = convert_many(headers[:1], jobs=1, manifest=manifest,
+                               split=True)
+        self.assertFalse(results[0].skipped)
+        self.assertTrue(os.path.exists(sibling))
+        with open(sibling, 'a') as file_object:
+            file_object.write('# Edited by hand.\n')
+        os.utime(sibling, (0, 0))
+        results = convert_many(headers[:1], jobs=1, manifest=manifest,
+                               split=True)
+        self.assertFalse(results[0].skipped)
+        # Several headers might write different versions of the same file.
+        self.assertRaises(ValueError, convert_many, headers, jobs=1,
+                          split=True, symbols=['func'])
+        shutil.rmtree(temp_dir)
+
+    def test_anonymousNamesAreDeterministic(self):
+        """
+        Parsing the same file twice results in the same generated names.
+        """
+        self.writeToTempFile(testing_pairs['nested_structs_and_unions'][0])
+        outputs = []
+        for _i in xrange(2):
+            output_object = StringIO()
+            CFileParser(self.temp_file).render_cython_header(output_object)
+            outputs.append(output_object.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(len(set(re.findall(r"_anonymous_[0-9a-f]{6}",
+                                            outputs[0]))), 2)
+
+    def test_typeCollectionIsDeduplicated(self):
+        """
+        Every type is only collected once, no matter how often it is used.
+        """
+        self.writeToTempFile('#include <stdint.h>\n' +
+            'uint32_t func_a(uint32_t a, uint32_t b);\n' +
+            'uint32_t func_b(uint32_t a, int b);\n')
+        parser = CFileParser(self.temp_file)
+        self.assertEqual(len(parser.type_collection), 1)
+        external_types = sum(parser.sorted_external_types.values(), [])
+        self.assertEqual([_i.spelling for _i in external_types], ['uint32_t'])
+
+    def test_typeChainCache(self):
+        """
+        Every distinct type is only resolved once.
+        """
+        self.writeToTempFile('typedef float newFloat;\n' +
+            'newFloat *func_a(newFloat *a, const char *b);\n' +
+            'newFloat *func_b(newFloat *a, const char *b);\n')
+        parser = CFileParser(self.temp_file)
+        chains = sorted(_i[0] for _i in parser.type_chain_cache.values())
+        self.assertEqual(chains, [('__pointer__', 'char'),
+                                  ('__pointer__', 'newFloat'), ('float',)])
+
+    def test_iterCythonLines(self):
+        """
+        The streamed lines are the same as the rendered file.
+        """
+        self.writeToTempFile(testing_pairs['typedefed_and_normal_constructs'][0])
+        parser = CFileParser(self.temp_file)
+        lines = list(parser.iter_cython_lines())
+        for line in lines:
+            self.assertTrue(line.endswith('\n'))
+            self.assertEqual(line.count('\n'), 1)
+        output_object = StringIO()
+        parser.render_cython_header(output_object)
+        self.assertEqual(''.join(lines), output_object.getvalue())
+
+    def test_lazyParsing(self):
+        """
+        Lazy parsers only parse nodes on demand but render the same output.
+        """
+        for key, value in testing_pairs.iteritems():
+            self.writeToTempFile(value[0])
+            outputs = []
+            for lazy in (False, True):
+                parser = CFileParser(self.temp_file, lazy=lazy)
+                if lazy:
+                    self.assertFalse(any(_i.is_parsed for _i in
+                        parser.toplevel_nodes if not
+                        isinstance(_i, nodes.MacroDefinitionNode)))
+                output_object = StringIO()
+                parser.render_cython_header(output_object)
+                outputs.append(output_object.getvalue())
+            self.assertEqual(outputs[0], outputs[1], key)
+
+    def test_symbolAllowlist(self):
+        """
+        Only the requested symbols and their dependencies are rendered.
+        """
+        self.writeToTempFile("""
+#include <stdint.h>
+#define WANTED_CONSTANT 1
+#define OTHER_CONSTANT 2
+typedef struct {
+    int8_t a;
+} item_t;
+struct unused {
+    float b;
+};
+typedef item_t *item_pointer;
+item_pointer get_item(int index);
+void unused_function(struct unused *a);
+""".strip())
+        parser = CFileParser(self.temp_file,
+                             symbols=['get_item', 'WANTED_*'])
+        output_object = StringIO()
+        parser.render_cython_header(output_object)
+        output = output_object.getvalue()
+        for name in ('WANTED_CONSTANT', 'int8_t a', 'item_t',
+                     'ctypedef item_t *item_pointer', 'get_item'):
+            self.assertTrue(name in output, name)
+        for name in ('OTHER_CONSTANT', 'unused'):
+            self.assertFalse(name in output, name)
+
+    def test_symbolsNestedRecord(self):
+        """
+        Named records declared inside of another record are found as well.
+        """
+        self.writeToTempFile("""
+typedef int inner_value;
+struct outer {
+    struct inner {
+        inner_value x;
+    } a;
+};
+int uses_inner(struct inner *p);
+int unused_function(int a);
+""".strip())
+        parser = CFileParser(self.temp_file, symbols=['uses_inner'])
+        output = ''.join(parser.iter_cython_lines())
+        for name in ('ctypedef int inner_value', 'cdef struct inner:',
+                     'inner_value x', 'int uses_inner(inner *p)'):
+            self.assertTrue(name in output, name)
+        self.assertFalse('unused_function' in output)
+
+    def test_symbolsSharedNestedRecord(self):
+        """
+        A nested record used by another record is rendered exactly once and
+        before all records using it.
+        """
+        self.writeToTempFile("""
+struct A {
+    struct in {
+        int v;
+    } x;
+};
+struct B {
+    struct in y;
+};
+int useA(struct A *a);
+int useB(struct B *b);
+""".strip())
+        for symbols in (['useB'], ['useB', 'useA']):
+            parser = CFileParser(self.temp_file, symbols=symbols)
+            lines = list(parser.iter_cython_lines())
+            self.assertEqual(lines.count('    cdef struct in:\n'), 1)
+            position = lines.index('    cdef struct in:\n')
+            self.assertTrue(position < lines.index('    cdef struct B:\n'))
+            if 'useA' in symbols:
+                self.assertTrue(position <
+                                lines.index('    cdef struct A:\n'))
+            else:
+                self.assertFalse('    cdef struct A:\n' in lines)
+
+    def test_parseProfiles(self):
+        """
+        The fast profile skips function bodies. Macros can be switched off.
+        """
+        self.writeToTempFile("""
+#define SOME_CONSTANT 1
+#ifdef EXTRA
+int extra_func(int a);
+#endif
+static inline int helper(int a) { return a * SOME_CONSTANT; }
+""".strip())
+        outputs = {}
+        for profile in ('default', 'fast'):
+            for macros in (True, False):
+                parser = CFileParser(self.temp_file, args=['-DEXTRA'],
+                                     profile=profile, macros=macros)
+                output_object = StringIO()
+                parser.render_cython_header(output_object)
+                outputs[(profile, macros)] = output_object.getvalue()
+        self.assertEqual(outputs[('default', True)], outputs[('fast', True)])
+        self.assertEqual(outputs[('default', False)], outputs[('fast', False)])
+        self.assertTrue('enum: SOME_CONSTANT' in outputs[('fast', True)])
+        self.assertFalse('SOME_CONSTANT' in outputs[('fast', False)])
+        self.assertTrue('int extra_func(int a)' in outputs[('fast', False)])
+        self.assertRaises(ValueError, CFileParser, self.temp_file,
+                          profile='unknown')
+
+    def test_isLocalFile(self):
+        """
+        Only files in the directory of the header are local.
+        """
+        self.writeToTempFile("int some_func(int a);")
+        parser = CFileParser(self.temp_file)
+        directory = os.path.dirname(self.temp_file)
+        self.assertTrue(parser.is_local_file(self.temp_file))
+        self.assertTrue(parser.is_local_file(
+            os.path.join(directory, '.', os.path.basename(self.temp_file))))
+        self.assertFalse(parser.is_local_file('/usr/include/stdio.h'))
+        # The decision is cached.
+        self.assertTrue(self.temp_file in parser._is_local_filename)
+
+    def test_parserStats(self):
+        """
+        Tests the timings and counters of the parser.
+        """
+        self.writeToTempFile("""
+#include <stdint.h>
+#define SOME_CONSTANT 1
+typedef struct {
+    int a;
+} some_struct;
+int some_func(uint8_t a, some_struct *b);
+""".strip())
+        parser = CFileParser(self.temp_file)
+        output_object = StringIO()
+        parser.render_cython_header(output_object)
+        stats = parser.stats.to_dict()
+        self.assertEqual(sorted(stats['timings']), sorted(
+            ['parse', 'sort', 'resolve', 'external_types', 'render']))
+        self.assertTrue(stats['timings']['parse'] > 0.0)
+        self.assertEqual(stats['node_counts']['FunctionProtoNode'], 1)
+        self.assertEqual(stats['node_counts']['MacroDefinitionNode'], 1)
+        self.assertEqual(stats['includes'], len(parser.includes))
+        self.assertEqual(stats['external_types'], 1)
+        self.assertEqual(stats['output_lines'],
+                         output_object.getvalue().count('\n'))
+        self.assertEqual(json.loads(parser.stats.to_json()), stats)
+
+    def test_fromString(self):
+        """
+        Headers can be parsed from strings, including the files they include.
+        """
+        directory = os.path.join(tempfile.gettempdir(), 'does_not_exist')
+        parser = CFileParser.from_string("""
+#include <stdint.h>
+#include "types.h"
+#define SOME_CONSTANT 1
+int some_func(some_type a, uint8_t b);
+""".strip(), os.path.join(directory, 'wrapper.h'),
+            extra_files={'types.h': 'typedef struct {\n int a;\n} some_type;'})
+        output = ''.join(parser.iter_cython_lines())
+        self.assertFalse(os.path.exists(directory))
+        self.assertTrue('cdef extern from "wrapper.h" nogil:' in output)
+        self.assertTrue('enum: SOME_CONSTANT' in output)
+        self.assertTrue('int some_func(some_type a, uint8_t b)' in output)
+        # The included in-memory file is part of the library, stdint.h is not.
+        self.assertTrue('ctypedef Struct_anonymous_' in output)
+        self.assertTrue('ctypedef unsigned char uint8_t' in output)
+        self.assertEqual(parser.files_to_parse, set([
+            os.path.join(directory, 'wrapper.h'),
+            os.path.join(directory, 'types.h')]))
+
+    def test_parserSession(self):
+        """
+        Parsers created by a session share the index and the include
+        directives of system headers but produce the same output.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('a.h', 'b.h'):
+                with open(os.path.join(directory, name), 'w') as file_object:
+                    file_object.write('#include <stdint.h>\n'
+                                      'int %s_func(uint8_t a);' % name[0])
+            session = ParserSession(args=['-DSOME_MACRO'])
+            for name in ('a.h', 'b.h'):
+                filename = os.path.join(directory, name)
+                parser = session.parse(filename)
+                self.assertTrue(parser.index is session.index)
+                self.assertEqual(parser.args, ['-DSOME_MACRO'])
+                self.assertEqual(''.join(parser.iter_cython_lines()),
+                    ''.join(CFileParser(filename).iter_cython_lines()))
+            # Only system headers are shared.
+            self.assertTrue(session.include_lines)
+            for filename in session.include_lines:
+                self.assertFalse(filename.startswith(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_intermediateRepresentation(self):
+        """
+        The parsed header can be detached from libclang, pickled and rendered
+        again.
+        """
+        self.writeToTempFile("""
+#include <stdint.h>
+typedef struct {
+    int (*callback)(void *data, uint8_t length);
+    union {
+        float a;
+        int b;
+    } value;
+} some_struct;
+int some_func(some_struct *a, char names[4][8]);
+""".strip())
+        parser = CFileParser(self.temp_file)
+        expected = ''.join(parser.iter_cython_lines())
+        header = parser.detach()
+        self.assertTrue(parser.translation_unit is None)
+        self.assertEqual(parser.toplevel_nodes, [])
+        self.assertEqual(''.join(parser.iter_cython_lines()), expected)
+        self.assertEqual(parser.get_include_closure()[0],
+                         os.path.abspath(self.temp_file))
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            copy = pickle.loads(pickle.dumps(header, protocol))
+            self.assertEqual(copy, header)
+            self.assertEqual(''.join(copy.iter_cython_lines()), expected)
+        # Only slotted records.
+        self.assertFalse(hasattr(header, '__dict__'))
+        function = header.declarations[-1]
+        self.assertTrue(isinstance(function, ir.Function))
+        self.assertEqual(function.name, 'some_func')
+        self.assertEqual(function.filename, self.temp_file)
+        self.assertTrue('some_struct' in function.dependencies)
+        self.assertEqual(function.params[1].chain,
+                         (('__array__', 4), ('__array__', 8), 'char'))
+
+    def test_snapshot(self):
+        """
+        Dumps a parsed header to a snapshot and renders it again.
+        """
+        self.writeToTempFile("""
+#include <stdint.h>
+#include <stdarg.h>
+#define SOME_CONSTANT 1
+enum some_enum {A, B};
+typedef struct {
+    int (*callback)(void *data, uint8_t length);
+    struct {
+        float a[2][3];
+    } value;
+} some_struct;
+int some_func(some_struct *a, const char *format, va_list args);
+""".strip())
+        parser = CFileParser(self.temp_file)
+        expected = ''.join(parser.iter_cython_lines())
+        snapshot_file = self.temp_file + '.snapshot'
+        try:
+            parser.dump(snapshot_file)
+            loaded = snapshot.load(snapshot_file)
+            self.assertEqual(loaded.header, parser.get_ir())
+            self.assertEqual(loaded.dependencies,
+                             parser.get_include_closure())
+            output_object = StringIO()
+            loaded.render_cython_header(output_object)
+            self.assertEqual(output_object.getvalue(), expected)
+            # Unknown versions are refused.
+            with open(snapshot_file, 'r') as file_object:
+                lines = file_object.readlines()
+            info = json.loads(lines[0])
+            info['version'] += 1
+            lines[0] = json.dumps(info) + '\n'
+            with open(snapshot_file, 'w') as file_object:
+                file_object.writelines(lines)
+            self.assertRaises(ValueError, snapshot.load, snapshot_file)
+        finally:
+            if os.path.exists(snapshot_file):
+                os.remove(snapshot_file)
+
+    def test_onlyIfChanged(self):
+        """
+        Unchanged output files are not rewritten.
+        """
+        self.writeToTempFile('int some_func(int a);')
+        output = self.temp_file + '.pxd'
+        try:
+            parser = CFileParser(self.temp_file)
+            self.assertTrue(parser.render_cython_header(output,
+                                                        only_if_changed=True))
+            os.utime(output, (1000, 1000))
+            parser = CFileParser(self.temp_file)
+            self.assertFalse(parser.render_cython_header(output,
+                                                         only_if_changed=True))
+            self.assertEqual(os.path.getmtime(output), 1000)
+            # A changed header replaces the file.
+            self.writeToTempFile('int some_func(int a, int b);')
+            results = convert_many([self.temp_file], [output], jobs=1,
+                                   only_if_changed=True)
+            self.assertTrue(results[0].changed)
+            self.assertNotEqual(os.path.getmtime(output), 1000)
+            with open(output, 'r') as file_object:
+                self.assertTrue('int some_func(int a, int b)' in
+                                file_object.read())
+            results = convert_many([self.temp_file], [output], jobs=1,
+                                   only_if_changed=True)
+            self.assertFalse(results[0].changed)
+        finally:
+            if os.path.exists(output):
+                os.remove(output)
+
+    def test_splitOutput(self):
+        """
+        Writes one file per header and cimports the types between them.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'types.h'), 'w') as file_object:
+                file_object.write('#include <stdint.h>\n'
+                                  'typedef struct {\n uint8_t x;\n} point;\n'
+                                  '#define SOME_CONSTANT 1\n')
+            with open(os.path.join(directory, 'main.h'), 'w') as file_object:
+                file_object.write('#include "types.h"\n'
+                                  'int draw(point *p, int n);\n')
+            parser = CFileParser(os.path.join(directory, 'main.h'))
+            output = os.path.join(directory, 'main.pxd')
+            written = parser.render_split_cython_headers(output)
+            self.assertEqual(written.keys(),
+                             [output, os.path.join(directory, 'types.pxd')])
+            with open(output, 'r') as file_object:
+                main = file_object.read()
+            with open(os.path.join(directory, 'types.pxd'), 'r') as \
+                    file_object:
+                types = file_object.read()
+            self.assertTrue(main.startswith('from types cimport point\n\n'))
+            self.assertTrue('cdef extern from "main.h" nogil:\n'
+                            '    int draw(point *p, int n)' in main)
+            self.assertFalse('uint8_t' in main)
+            self.assertFalse('cimport' in types)
+            self.assertTrue('ctypedef unsigned char uint8_t' in types)
+            self.assertTrue('cdef extern from "types.h" nogil:' in types)
+            self.assertTrue('enum: SOME_CONSTANT' in types)
+            self.assertTrue('ctypedef Struct_anonymous_' in types)
+            # Nothing changed.
+            self.assertEqual(parser.render_split_cython_headers(output,
+                only_if_changed=True, package='pkg').values(), [True, False])
+            with open(output, 'r') as file_object:
+                self.assertTrue(file_object.read().startswith(
+                    'from pkg.types cimport point\n'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_splitOutputModules(self):
+        """
+        Split files are named after valid and unique module names and the
+        extern blocks use the include spelling.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            name = os.path.join(directory, 'main.h')
+            extra_files = {'sys/types.h': 'typedef int point;',
+                           'foo-bar.h': 'typedef int fb_t;',
+                           'sub/main.h': 'typedef int sub_t;',
+                           'a/t.h': 'typedef int a_t;',
+                           'b/t.h': 'typedef int b_t;'}
+            parser = CFileParser.from_string(
+                '#include "sys/types.h"\n#include "foo-bar.h"\n'
+                'int draw(point p, fb_t f);', name, extra_files=extra_files)
+            output = os.path.join(directory, 'main.pxd')
+            written = parser.render_split_cython_headers(output)
+            self.assertEqual(written.keys(), [output,
+                os.path.join(directory, 'types.pxd'),
+                os.path.join(directory, 'foo_bar.pxd')])
+            with open(output, 'r') as file_object:
+                main = file_object.read()
+            self.assertTrue('from foo_bar cimport fb_t\n' in main)
+            self.assertTrue('from types cimport point\n' in main)
+            with open(os.path.join(directory, 'types.pxd'), 'r') as \
+                    file_object:
+                types = file_object.read()
+            self.assertTrue(types.startswith(
+                'cdef extern from "sys/types.h" nogil:\n'))
+            # The spellings are part of the intermediate representation, so
+            # detached parsers and snapshots are split the same way.
+            snapshot_file = os.path.join(directory, 'main.snapshot')
+            parser.dump(snapshot_file)
+            parser.detach()
+            os.remove(os.path.join(directory, 'types.pxd'))
+            parser.render_split_cython_headers(output)
+            with open(os.path.join(directory, 'types.pxd'), 'r') as \
+                    file_object:
+                self.assertEqual(file_object.read(), types)
+            headers = split.split_header(snapshot.load(snapshot_file).header,
+                                         root_filename=name)
+            self.assertEqual(''.join(headers['types'].iter_cython_lines()),
+                             types)
+            # Different files ending up in the same module.
+            for source in ('#include "sub/main.h"\nint f(sub_t a);',
+                           '#include "a/t.h"\n#include "b/t.h"\n'
+                           'int f(a_t a, b_t b);'):
+                parser = CFileParser.from_string(source, name,
+                                                 extra_files=extra_files)
+                self.assertRaises(ValueError,
+                                  parser.render_split_cython_headers, output)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_reparse(self):
+        """
+        Reparses changed headers and only converts the changed ones again in
+        watch mode.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            types_h = os.path.join(directory, 'types.h')
+            main_h = os.path.join(directory, 'main.h')
+            other_h = os.path.join(directory, 'other.h')
+            with open(types_h, 'w') as file_object:
+                file_object.write('typedef int number;\n')
+            with open(main_h, 'w') as file_object:
+                file_object.write('#include "types.h"\nnumber f(void);\n')
+            with open(other_h, 'w') as file_object:
+                file_object.write('int g(void);\n')
+            parser = CFileParser(main_h, profile='watch')
+            self.assertTrue('ctypedef int number' in
+                            ''.join(parser.iter_cython_lines()))
+            with open(types_h, 'w') as file_object:
+                file_object.write('typedef long number;\n#define N 1\n')
+            parser.reparse()
+            output = ''.join(parser.iter_cython_lines())
+            self.assertTrue('ctypedef long number' in output)
+            self.assertTrue('enum: N' in output)
+            self.assertEqual(parser.stats.node_counts['TypedefNode'], 1)
+            parser.reparse(unsaved_files=[(main_h, 'int h(void);\n')])
+            self.assertEqual(''.join(parser.iter_cython_lines()),
+                             'cdef extern from "main.h" nogil:\n'
+                             '    int h()\n')
+
+            watcher = Watcher([main_h, other_h], profile='watch')
+            results = watcher.check()
+            self.assertEqual([_i.header for _i in results], [main_h, other_h])
+            self.assertTrue(all(_i.success for _i in results))
+            self.assertEqual(watcher.check(), [])
+            # Make sure the modification time changes.
+            with open(types_h, 'w') as file_object:
+                file_object.write('typedef short number;\n')
+            os.utime(types_h, (0, 0))
+            results = watcher.check()
+            self.assertEqual([_i.header for _i in results], [main_h])
+            with open(os.path.join(directory, 'main.pxd'), 'r') as \
+                    file_object:
+                self.assertTrue('ctypedef short number' in file_object.read())
+            self.assertEqual(watcher.check(), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_conversionServer(self):
+        """
+        Converts headers with a conversion server running in a thread.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            socket_path = os.path.join(directory, 'server.sock')
+            header = os.path.join(directory, 'a.h')
+            with open(header, 'w') as file_object:
+                file_object.write('int f(int a);\n')
+            server = daemon.ConversionServer(socket_path)
+            thread = threading.Thread(target=server.serve)
+            thread.start()
             try:
-                assert(output == cython_code)
-            except AssertionError:
-                d = difflib.Differ()
-                diff = d.compare(output.splitlines(), cython_code.splitlines())
-                diff = list(diff)
-
-                print Fore.BLUE
-                print '=' * 80
-                print '=' * 80, Fore.RESET
-                print 'Error in test construct:', Fore.GREEN, key, Fore.BLUE
-                print '_' * 80, Fore.YELLOW
-                print 'C code:', Fore.RESET
-                print c_code, Fore.BLUE
-                print '_' * 80, Fore.YELLOW
-                print 'Expected cython code:', Fore.RESET
-                print cython_code, Fore.BLUE
-                print '_' * 80, Fore.YELLOW
-                print 'Received cython code (- needs to go, + to get there):',\
-                    Fore.RESET
-
-                for line in diff:
-                    if line.startswith('  '):
-                        print Back.GREEN, Fore.WHITE, line[2:], Style.RESET_ALL
-                    elif line.startswith('+ ') or \
-                         line.startswith('- '):
-                        print Back.RED, Fore.WHITE, line, Style.RESET_ALL
-                print Fore.RESET, Back.RESET
-
-                print Fore.BLUE
-                print '=' * 80, Fore.BLUE
-                print '=' * 80, Fore.RESET
-                raise Exception
+                self.assertTrue(daemon.is_running(socket_path))
+                self.assertRaises(daemon.DaemonError, daemon.ConversionServer,
+                                  socket_path)
+                result = daemon.convert(socket_path, header, macros=False)
+                self.assertTrue(result.success)
+                self.assertTrue(result.changed)
+                with open(os.path.join(directory, 'a.pxd'), 'r') as \
+                        file_object:
+                    self.assertEqual(file_object.read(),
+                                     'cdef extern from "a.h" nogil:\n'
+                                     '    int f(int a)\n')
+                # The parsed header is reused.
+                self.assertEqual(len(server.watchers), 1)
+                result = daemon.convert(socket_path, header,
+                                        only_if_changed=True, macros=False)
+                self.assertFalse(result.changed)
+                result = daemon.convert(socket_path, 'missing.h')
+                self.assertFalse(result.success)
+                self.assertTrue('TranslationUnitLoadError' in result.error)
+                self.assertRaises(daemon.DaemonError, daemon.send_request,
+                                  socket_path, {'command': 'unknown'})
+            finally:
+                daemon.send_request(socket_path, {'command': 'shutdown'})
+                thread.join()
+            self.assertFalse(os.path.exists(socket_path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_conversionServerChanges(self):
+        """
+        The conversion server picks up changed system headers, only keeps a
+        limited number of sessions and does not wait forever for idle
+        clients.
+        """
+        directory = tempfile.mkdtemp()
+        timeout = daemon.ConversionRequestHandler.timeout
+        try:
+            include_directory = os.path.join(directory, 'include')
+            source_directory = os.path.join(directory, 'source')
+            os.mkdir(include_directory)
+            os.mkdir(source_directory)
+            for name, contents in (('types_a.h', 'typedef int ext_t;\n'),
+                                   ('types_b.h', 'typedef long ext_t;\n'),
+                                   ('ext.h', '#include "types_a.h"\n')):
+                with open(os.path.join(include_directory, name), 'w') as \
+                        file_object:
+                    file_object.write(contents)
+            header = os.path.join(source_directory, 'a.h')
+            output = os.path.join(source_directory, 'a.pxd')
+            with open(header, 'w') as file_object:
+                file_object.write('#include <ext.h>\next_t f(void);\n')
+            socket_path = os.path.join(directory, 'server.sock')
+            daemon.ConversionRequestHandler.timeout = 0.2
+            server = daemon.ConversionServer(socket_path, max_sessions=2)
+            thread = threading.Thread(target=server.serve)
+            thread.start()
+            try:
+                args = ['-I%s' % include_directory]
+                result = daemon.convert(socket_path, header, args=args)
+                self.assertTrue(result.success)
+                with open(output, 'r') as file_object:
+                    self.assertTrue('cdef extern from "types_a.h" nogil:\n'
+                                    '    ctypedef int ext_t' in
+                                    file_object.read())
+                # Include another file in the same line of the system header.
+                with open(os.path.join(include_directory, 'ext.h'), 'w') as \
+                        file_object:
+                    file_object.write('#include "types_b.h"\n')
+                os.utime(os.path.join(include_directory, 'ext.h'), (0, 0))
+                result = daemon.convert(socket_path, header, args=args)
+                self.assertTrue(result.success)
+                with open(output, 'r') as file_object:
+                    self.assertTrue('cdef extern from "types_b.h" nogil:\n'
+                                    '    ctypedef long ext_t' in
+                                    file_object.read())
+
+                # An idle client does not block the others.
+                idle_client = socket.socket(socket.AF_UNIX,
+                                            socket.SOCK_STREAM)
+                idle_client.connect(socket_path)
+                try:
+                    self.assertEqual(daemon.send_request(socket_path,
+                        {'command': 'ping'}, timeout=5.0), {'success': True})
+                finally:
+                    idle_client.close()
+
+                # The least recently used session is dropped.
+                watcher = server.watchers.values()[0]
+                for define in ('-DA', '-DB'):
+                    self.assertTrue(daemon.convert(socket_path, header,
+                        args=args + [define]).success)
+                self.assertEqual(len(server.watchers), 2)
+                self.assertFalse(watcher in server.watchers.values())
+                self.assertEqual(watcher.parsers, {})
+            finally:
+                daemon.send_request(socket_path, {'command': 'shutdown'})
+                thread.join()
+        finally:
+            daemon.ConversionRequestHandler.timeout = timeout
+            shutil.rmtree(directory)
+
+
+def _get_construct_test(key):
+    def test(self):
+        self.assertConstructOutput(key, *parse_construct(key))
+    test.__doc__ = 'Tests the testing construct %s.' % key
+    return test
+
+# One test per testing construct so they can be run and fail separately.
+for _key in testing_pairs:
+    setattr(HeaderToCythonTestCase, 'test_testingConstruct_%s' % _key,
+            _get_construct_test(_key))
 
 
 # Launch this files unit tests and the modules doctests.
@@ -121,7 +964,12 @@ if __name__ == '__main__':
     unittest_suite = \
         unittest.TestLoader().loadTestsFromTestCase(HeaderToCythonTestCase)
     doctest_suite = unittest.TestSuite()
+    doctest_suite.addTest(doctest.DocTestSuite(head2cydef))
+    doctest_suite.addTest(doctest.DocTestSuite(ir))
     doctest_suite.addTest(doctest.DocTestSuite(nodes))
+    doctest_suite.addTest(doctest.DocTestSuite(snapshot))
+    doctest_suite.addTest(doctest.DocTestSuite(split))
+    doctest_suite.addTest(doctest.DocTestSuite(stats))
 
     alltests = unittest.TestSuite([unittest_suite, doctest_suite])
     unittest.main(defaultTest='alltests')
@@ -139,10 +139,10 @@ typedef struct {
 """.strip(),
 """
 cdef extern from [[[FILENAME]]] nogil:
-    cdef struct Struct_temp_random_[[RANDOMINT]]:
+    cdef struct Struct_anonymous_[[ID]]:
         float *member_a
         int member_b
-    ctypedef Struct_temp_random_[[RANDOMINT]] testStruct
+    ctypedef Struct_anonymous_[[ID]] testStruct
 """.strip()
 )
 
@@ -189,10 +189,10 @@ typedef union {
 """.strip(),
 """
 cdef extern from [[[FILENAME]]] nogil:
-    cdef union Union_temp_random_[[RANDOMINT]]:
+    cdef union Union_anonymous_[[ID]]:
         float *member_a
         int member_b
-    ctypedef Union_temp_random_[[RANDOMINT]] testUnion
+    ctypedef Union_anonymous_[[ID]] testUnion
 """.strip()
 )
 
@@ -265,10 +265,10 @@ typedef enum {
 """.strip(),
 """
 cdef extern from [[[FILENAME]]] nogil:
-    cdef enum Enum_temp_random_[[RANDOMINT]]:
+    cdef enum Enum_anonymous_[[ID]]:
         member_a
         member_b
-    ctypedef Enum_temp_random_[[RANDOMINT]] testEnum
+    ctypedef Enum_anonymous_[[ID]] testEnum
 """.strip()
 )
 
@@ -505,10 +505,10 @@ typedef enumName (*function)(const float* data, void* other_data);
 """.strip(),
 """
 cdef extern from [[[FILENAME]]] nogil:
-    cdef enum Enum_temp_random_[[RANDOMINT]]:
+    cdef enum Enum_anonymous_[[ID]]:
         RETRY
         BREAK
-    ctypedef Enum_temp_random_[[RANDOMINT]] enumName
+    ctypedef Enum_anonymous_[[ID]] enumName
     ctypedef enumName (*function)(float* data, void* other_data)
 """.strip()
 )
@@ -529,14 +529,14 @@ typedef struct outer_struct {
 """.strip(),
 """
 cdef extern from [[[FILENAME]]] nogil:
-    cdef struct Struct_temp_random_[[RANDOMINT]]:
+    cdef struct Struct_anonymous_[[ID]]:
         float *inner_struct_field_a
         int inner_struct_field_b
-    cdef union Union_temp_random_[[RANDOMINT]]:
-        Struct_temp_random_[[RANDOMINT]] inner_struct
+    cdef union Union_anonymous_[[ID]]:
+        Struct_anonymous_[[ID]] inner_struct
     cdef struct outer_struct:
         int field_1
-        Union_temp_random_[[RANDOMINT]] inner_union
+        Union_anonymous_[[ID]] inner_union
     ctypedef outer_struct outerStruct
 """.strip()
 )
@@ -590,3 +590,47 @@ cdef extern from [[[FILENAME]]] nogil:
     void test_func_2(void (*func)(unsigned int param_1, int param_2))
 """.strip()
 )
+
+# Records used by multiple fields must only be defined once.
+testing_pairs['records_used_by_multiple_fields'] = (
+"""
+struct point {
+    int x;
+    int y;
+};
+
+struct shape {
+    struct point origin;
+    struct {
+        float r;
+    } first, second;
+};
+""".strip(),
+"""
+cdef extern from [[[FILENAME]]] nogil:
+    cdef struct point:
+        int x
+        int y
+    cdef struct Struct_anonymous_[[ID]]:
+        float r
+    cdef struct shape:
+        point origin
+        Struct_anonymous_[[ID]] first
+        Struct_anonymous_[[ID]] second
+""".strip()
+)
+
+# Constants whose value contains parentheses are still constants.
+testing_pairs['define_constants_with_parentheses'] = (
+"""
+#define SHIFTED (1 << 3)
+#define NEGATIVE (-1)
+#define SQUARE(X) ((X) * (X))
+#define SPACED( X ) X
+""".strip(),
+"""
+cdef extern from [[[FILENAME]]] nogil:
+    enum: SHIFTED
+    enum: NEGATIVE
+""".strip()
+)
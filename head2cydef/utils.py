@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Assorted helper functions.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import hashlib
+import os
+import tempfile
+
+
+def get_file_hash(filename):
+    """
+    Returns the SHA1 hex digest of the contents of a file.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as file_object:
+        while True:
+            chunk = file_object.read(65536)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_string_hash(*items):
+    """
+    Returns the SHA1 hex digest of a number of strings.
+
+    >>> print get_string_hash('a', 'b')
+    5b4085401e259f3918fb1701d3d9399c2c8cce73
+    """
+    sha1 = hashlib.sha1()
+    for item in items:
+        sha1.update(item)
+        # Separate the items so ('ab', 'c') and ('a', 'bc') differ.
+        sha1.update('\0')
+    return sha1.hexdigest()
+
+
+def _read_umask():
+    """
+    The only portable way to get the umask is to set it which affects all
+    threads, so only do it once on import.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+_IMPORT_UMASK = _read_umask()
+
+
+def _get_umask():
+    """
+    The current umask of the process, if possible read from /proc without
+    changing it. Otherwise the umask at import time.
+    """
+    try:
+        with open('/proc/self/status', 'r') as file_object:
+            for line in file_object:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (IOError, ValueError, IndexError):
+        pass
+    return _IMPORT_UMASK
+
+
+def _get_default_file_mode():
+    return 0666 & ~_get_umask()
+
+
+def write_if_changed(filename, lines):
+    """
+    Writes the lines to filename unless the file already has exactly this
+    content. Returns True if the file was written.
+
+    An unchanged file keeps its modification time and does not trigger any
+    rebuilds.
+    """
+    content = ''.join(lines)
+    if os.path.exists(filename) and \
+       os.path.getsize(filename) == len(content) and \
+       get_file_hash(filename) == hashlib.sha1(content).hexdigest():
+        return False
+    write_atomically(filename, content)
+    return True
+
+
+def write_atomically(filename, content):
+    """
+    Writes the content to a temporary file which then replaces filename, so
+    readers and concurrent writers never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    if os.path.exists(filename):
+        mode = os.stat(filename).st_mode & 0777
+    else:
+        mode = _get_default_file_mode()
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix='.%s.' %
+                                         os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as file_object:
+            file_object.write(content)
+        os.chmod(temp_filename, mode)
+        os.rename(temp_filename, filename)
+    except:
+        os.remove(temp_filename)
+        raise
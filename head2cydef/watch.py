@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Keep headers parsed in memory and convert them again whenever one of the
+files they include changes.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2012
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import os
+import time
+import traceback
+
+from batch import ConversionResult, get_default_output_filename, \
+    render_output
+from session import ParserSession
+
+
+def get_file_state(filename):
+    """
+    The modification time and size of a file or None if it does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+class Watcher(object):
+    """
+    Converts headers and keeps their translation units in memory. check()
+    polls the include closure of every header and reparses and renders only
+    the headers of which at least one file changed. Reparsing a translation
+    unit is much faster than parsing it from scratch.
+
+    Polling is used instead of e.g. inotify to not depend on anything but the
+    standard library. It only stats the files, typically a few dozen per
+    header.
+    """
+    def __init__(self, headers, outputs=None, only_if_changed=False,
+                 split=False, profile='watch', **kwargs):
+        """
+        :param headers: List of header filenames.
+        :param outputs: List of output filenames, one for each header.
+            Defaults to the header filenames with a .pxd extension.
+        :param only_if_changed: If True, output files are only replaced if
+            their content changes.
+        :param split: If True, write one file per header the declarations are
+            in, see CFileParser.render_split_cython_headers().
+        :param profile: The libclang parse profile. The default 'watch'
+            profile makes reparsing faster.
+
+        All further keyword arguments are passed to the ParserSession.
+        """
+        self.headers = list(headers)
+        if outputs is None:
+            outputs = [get_default_output_filename(_i) for _i in self.headers]
+        self.outputs = list(outputs)
+        if len(self.headers) != len(self.outputs):
+            msg = 'Need exactly one output filename for every header.'
+            raise ValueError(msg)
+        self.render_kwargs = {'only_if_changed': only_if_changed,
+                              'split': split}
+        self.session = ParserSession(profile=profile, **kwargs)
+        # The parser and the state of every file in the include closure of
+        # the last conversion, by header.
+        self.parsers = {}
+        self.file_states = {}
+
+    def _get_file_states(self, header, previous_states=None):
+        """
+        The state of every file in the include closure of a header. States in
+        previous_states take precedence.
+        """
+        parser = self.parsers.get(header)
+        if parser is None:
+            # Parsing failed, so only the header itself is known.
+            filenames = [os.path.abspath(header)]
+        else:
+            filenames = parser.get_include_closure()
+        previous_states = previous_states or {}
+        return dict((_i, previous_states[_i] if _i in previous_states else
+                     get_file_state(_i)) for _i in filenames)
+
+    def convert(self, header, output, **kwargs):
+        """
+        Converts a single header. If it was parsed before, it is only
+        reparsed if a file in its include closure changed. Returns a
+        ConversionResult and never raises.
+
+        Keyword arguments override only_if_changed and split of the watcher.
+        """
+        render_kwargs = dict(self.render_kwargs)
+        render_kwargs.update(kwargs)
+        start = time.time()
+        # Determine the file states before parsing so changes made during
+        # the conversion are not missed.
+        previous_states = self._get_file_states(header)
+        try:
+            parser = self.parsers.get(header)
+            changed_files = []
+            if header in self.file_states:
+                changed_files = self.get_changed_files(header)
+            # The include directives of system headers are shared within the
+            # session and might be outdated now.
+            if any(parser is None or not parser.is_local_file(_i) for _i in
+                   changed_files):
+                self.session.clear()
+            if parser is None:
+                parser = self.session.parse(header)
+                self.parsers[header] = parser
+            elif changed_files:
+                parser.reparse()
+            written = render_output(parser, output, **render_kwargs)
+        except Exception:
+            # Start from scratch the next time.
+            self.parsers.pop(header, None)
+            self.file_states[header] = self._get_file_states(header,
+                                                             previous_states)
+            return ConversionResult(header, output, False,
+                                    traceback.format_exc(),
+                                    time.time() - start, [], False, None,
+                                    False, [])
+        self.file_states[header] = self._get_file_states(header,
+                                                         previous_states)
+        return ConversionResult(header, output, True, None,
+                                time.time() - start,
+                                parser.get_include_closure(), False,
+                                parser.stats.to_dict(),
+                                any(written.itervalues()), written.keys())
+
+    def get_changed_files(self, header):
+        """
+        Returns the files in the include closure of the last conversion of a
+        header that changed since then.
+        """
+        return sorted(filename for filename, state in
+                      self.file_states[header].iteritems() if
+                      get_file_state(filename) != state)
+
+    def check(self):
+        """
+        Converts all headers of which a file changed since their last
+        conversion and returns a list of ConversionResult objects. Headers
+        that were not converted yet are converted as well.
+        """
+        results = []
+        for header, output in zip(self.headers, self.outputs):
+            if header in self.file_states and \
+               not self.get_changed_files(header):
+                continue
+            results.append(self.convert(header, output))
+        return results
+
+    def clear(self):
+        """
+        Forgets all parsed headers.
+        """
+        self.parsers.clear()
+        self.file_states.clear()
+        self.session.clear()
+
+    def iter_watch(self, interval=0.5):
+        """
+        Converts all headers and then checks for changes every interval
+        seconds forever. Yields every ConversionResult.
+        """
+        while True:
+            for result in self.check():
+                yield result
+            time.sleep(interval)
@@ -58,6 +58,9 @@ def setupPackage():
         package_dir={"head2cydef": "head2cydef"},
         zip_safe=False,
         install_requires=INSTALL_REQUIRES,
+        entry_points={
+            "console_scripts": ["head2cydef = head2cydef.cli:main"]
+        },
     )
 
 